@@ -1,24 +1,31 @@
 import streamlit as st
 import requests
 import os
+import uuid
 import time
 from dotenv import load_dotenv
 
+import audio_analysis
+import job_poller
+import metrics
+import resilience
+import suno_api
+import thumbnails
+import transcode
+
 # Загрузка переменных окружения из файла .env
 load_dotenv()
 
 # Получение API ключа из переменных окружения
 SUNO_API_KEY = os.getenv('SUNO_API_KEY')
 
-BASE_URL = "https://api.aimlapi.com"
+BASE_URL = suno_api.BASE_URL
 
-def generate_music(prompt, tags=None, title=None, make_instrumental=False, wait_audio=True):
-    """Generate music using the Suno v3.5 API"""
-    headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json"
-    }
+# Интервал автообновления статуса фоновых задач (секунды)
+UI_REFRESH_SECONDS = float(os.getenv('UI_REFRESH_SECONDS', '2'))
 
+def generate_music(prompt, tags=None, title=None, make_instrumental=False, wait_audio=True, fresh=False):
+    """Generate music using the Suno v3.5 API"""
     payload = {
         "prompt": prompt,
         "make_instrumental": make_instrumental,
@@ -30,20 +37,22 @@ def generate_music(prompt, tags=None, title=None, make_instrumental=False, wait_
     if title:
         payload["title"] = title
 
-    url = f"{BASE_URL}/generate/custom-mode"
-
     st.write("Отправка запроса к API...")
     st.json(payload)
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
-        st.write(f"Статус ответа: {response.status_code}")
-        response.raise_for_status()
-        return response.json()
+        return suno_api.submit_generation(prompt, make_instrumental, wait_audio, tags=tags, title=title,
+                                         custom_mode=True, fresh=fresh,
+                                         user=st.session_state.setdefault('user_id', str(uuid.uuid4())))
     except requests.exceptions.Timeout:
         st.error("Превышено время ожидания при подключении к API.")
+    except resilience.CircuitOpenError as e:
+        st.error(f"API временно недоступен: {str(e)}")
     except requests.exceptions.ConnectionError:
         st.error("Ошибка подключения к API. Пожалуйста, проверьте ваше интернет-соединение.")
+    except requests.exceptions.HTTPError as e:
+        st.write(f"Статус ответа: {e.response.status_code}")
+        st.error(f"Произошла ошибка при запросе к API: {str(e)}")
     except requests.exceptions.RequestException as e:
         st.error(f"Произошла ошибка при запросе к API: {str(e)}")
     
@@ -52,21 +61,77 @@ def generate_music(prompt, tags=None, title=None, make_instrumental=False, wait_
 
 def fetch_music_details(music_id):
     """Fetch details of generated music using its ID"""
-    headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    url = f"{BASE_URL}/?ids[0]={music_id}"
-
     try:
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        return suno_api.fetch_details([music_id], user=st.session_state.setdefault('user_id', str(uuid.uuid4())))
     except requests.exceptions.RequestException as e:
         st.error(f"Error in fetch_music_details: {str(e)}")
         return None
 
+def display_analysis(analysis, track):
+    """Осциллограмма и параметры трека из сохраненного анализа, без повторного чтения аудио"""
+    st.area_chart(analysis['peaks'], height=80)
+    minutes, seconds = divmod(int(round(analysis['duration'])), 60)
+    parts = [f"Длительность: {minutes}:{seconds:02d}"]
+    if analysis.get('bpm'):
+        parts.append(f"темп ≈ {analysis['bpm']:.0f} BPM")
+    if analysis.get('loudness_lufs') is not None:
+        parts.append(f"громкость {analysis['loudness_lufs']:.1f} LUFS")
+    parts.append(f"RMS {analysis['rms_dbfs']:.1f} dBFS")
+    st.caption(", ".join(parts))
+    for problem in audio_analysis.mismatches(analysis, track):
+        st.warning(f"Не совпадает с запросом: {problem}")
+
+def display_track(track):
+    """Отображение трека из ответа API"""
+    st.subheader(f"Трек: {track.get('title', 'Без названия')}")
+    
+    audio_url = track.get('audio_url')
+    if audio_url:
+        # Играется облегченная версия; пока она готовится в фоне - отрывок или исходный URL
+        source, mime, kind = transcode.playback_source(audio_url)
+        st.audio(source, format=mime)
+        if kind == 'clip':
+            st.caption(f"Отрывок: первые {transcode.CLIP_SECONDS:.0f} секунд, полная облегченная версия готовится")
+        analysis = audio_analysis.for_url(audio_url)
+        if analysis:
+            display_analysis(analysis, track)
+    elif track.get('status') and track['status'] not in job_poller.FINAL_STATUSES:
+        st.info("Аудио еще генерируется...")
+    else:
+        st.warning("URL аудио не найден для этого трека.")
+    
+    image_url = track.get('image_url')
+    if image_url:
+        st.image(thumbnails.local_image(image_url, thumbnails.PAGE_WIDTH), caption="Обложка трека")
+    
+    lyric = track.get('lyric')
+    if lyric:
+        with st.expander("Показать текст песни"):
+            st.text(lyric)
+    
+    st.write(f"Модель: {track.get('model_name', 'Не указана')}")
+    st.write(f"Статус: {track.get('status', 'Не указан')}")
+    st.write(f"Создано: {track.get('created_at', 'Не указано')}")
+    
+    st.divider()
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def display_pending_jobs():
+    """Автообновляемые карточки фоновых задач: название и текст, затем обложка и аудио появляются по мере готовности"""
+    tracks, pending = job_poller.refresh_tracks(st.session_state['job_tracks'])
+    st.session_state['job_tracks'] = tracks
+
+    if pending:
+        ready = sum(1 for track in tracks if track.get('audio_url'))
+        st.info(f"Музыка генерируется в фоновом режиме: готово треков {ready} из {len(tracks)}. "
+                "Треки появляются на странице по мере готовности.")
+        for track in tracks:
+            display_track(track)
+    else:
+        # Все задачи завершены: перерисовываем страницу целиком
+        st.session_state['job_done'] = True
+        st.rerun()
+
 def main():
     st.title("AI Music Generator")
     st.write("Опишите музыку, которую вы хотите сгенерировать, и наш ИИ создаст ее для вас!")
@@ -77,10 +142,11 @@ def main():
     title = st.text_input("Название трека:", value="Sunny Day Song")
     make_instrumental = st.checkbox("Сделать инструментальной")
     wait_audio = st.checkbox("Ждать генерации аудио", value=True)
+    fresh = st.checkbox("Новый вариант (не брать готовый результат для такого же запроса)", value=False)
 
     if st.button("Сгенерировать музыку"):
         with st.spinner("Генерация музыки..."):
-            result = generate_music(prompt, tags, title, make_instrumental, wait_audio)
+            result = generate_music(prompt, tags, title, make_instrumental, wait_audio, fresh)
             if result:
                 st.success("Запрос на генерацию музыки успешно отправлен!")
                 st.json(result)
@@ -88,45 +154,29 @@ def main():
                 if wait_audio:
                     if isinstance(result, list) and len(result) > 0:
                         for track in result:
-                            st.subheader(f"Трек: {track.get('title', 'Без названия')}")
-                            
-                            audio_url = track.get('audio_url')
-                            if audio_url:
-                                st.audio(audio_url, format='audio/wav')
-                            else:
-                                st.warning("URL аудио не найден для этого трека.")
-                            
-                            image_url = track.get('image_url')
-                            if image_url:
-                                st.image(image_url, caption="Обложка трека")
-                            
-                            lyric = track.get('lyric')
-                            if lyric:
-                                with st.expander("Показать текст песни"):
-                                    st.text(lyric)
-                            
-                            st.write(f"Модель: {track.get('model_name', 'Не указана')}")
-                            st.write(f"Статус: {track.get('status', 'Не указан')}")
-                            st.write(f"Создано: {track.get('created_at', 'Не указано')}")
-                            
-                            st.divider()
+                            display_track(track)
                     else:
                         st.warning("Неожиданный формат ответа от API.")
                 else:
-                    st.info("Музыка генерируется в фоновом режиме. Используйте ID задачи для получения результатов позже.")
-                    task_id = result.get('id')
-                    if task_id:
-                        st.write(f"ID задачи: {task_id}")
-                        if st.button("Получить детали генерации"):
-                            details = fetch_music_details(task_id)
-                            if details:
-                                st.json(details)
-                            else:
-                                st.error("Не удалось получить детали генерации.")
+                    tracks = suno_api.extract_tracks(result)
+                    if tracks and all(track.get('id') for track in tracks):
+                        job_poller.get_poller().submit(tracks)
+                        st.session_state['job_tracks'] = tracks
+                        st.session_state['job_done'] = False
                     else:
                         st.warning("ID задачи не найден в ответе API.")
             else:
                 st.error("Не удалось отправить запрос на генерацию музыки. Пожалуйста, попробуйте еще раз позже.")
 
+    if 'job_tracks' in st.session_state:
+        if st.session_state.get('job_done'):
+            st.success("Фоновая генерация завершена!")
+            for track in st.session_state['job_tracks']:
+                display_track(track)
+        else:
+            display_pending_jobs()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    metrics.start_exporters()
+    with metrics.rerun_timer("app"):
+        main()
\ No newline at end of file
@@ -1,9 +1,23 @@
 import streamlit as st
 import requests
 import os
+import uuid
 import time
 from dotenv import load_dotenv
-from io import BytesIO
+
+import audio_analysis
+import job_poller
+import job_queue
+import media_cache
+import metrics
+import prefetch
+import suno_api
+import thumbnails
+import track_library
+import transcode
+import variants
+import zip_export
+from prompts import generate_prompt
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -11,16 +25,17 @@ load_dotenv()
 # Получение API ключа из переменных окружения
 SUNO_API_KEY = os.getenv('SUNO_API_KEY')
 
-BASE_URL = "https://api.aimlapi.com"
+BASE_URL = suno_api.BASE_URL
+
+# Интервал автообновления статуса фоновых задач (секунды)
+UI_REFRESH_SECONDS = float(os.getenv('UI_REFRESH_SECONDS', '2'))
+# Сколько карточек треков выводится на одной странице списка
+TRACKS_PER_PAGE = int(os.getenv('TRACKS_PER_PAGE', '10'))
+# Генерация через очередь и отдельные процессы worker.py вместо потока интерфейса
+JOB_QUEUE_MODE = os.getenv('JOB_QUEUE_MODE', '0') == '1'
 
-def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True):
+def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True, fresh=False):
     """Генерация музыки и текста с использованием API Suno v3.5"""
-    url = f"{BASE_URL}/generate"
-    headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
         "prompt": prompt,
         "make_instrumental": make_instrumental,
@@ -32,26 +47,38 @@ def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True):
 
     try:
         with st.spinner("Генерация музыки и текста..."):
-            response = requests.post(url, json=payload, headers=headers)
+            result = suno_api.submit_generation(prompt, make_instrumental, wait_audio, fresh=fresh,
+                                                  user=st.session_state.setdefault('user_id', str(uuid.uuid4())))
         
-        if response.status_code in [200, 201]:
-            st.success("Запрос на генерацию музыки и текста успешно выполнен!")
-            result = response.json()
-            with st.expander("Просмотреть ответ API"):
-                st.json(result)
-            return result
-        else:
-            st.error(f"Ошибка при отправке запроса. Код статуса: {response.status_code}")
-            st.error(f"Ответ сервера: {response.text}")
+        st.success("Запрос на генерацию музыки и текста успешно выполнен!")
+        with st.expander("Просмотреть ответ API"):
+            st.json(result)
+        return result
+    except requests.exceptions.HTTPError as e:
+        st.error(f"Ошибка при отправке запроса. Код статуса: {e.response.status_code}")
+        st.error(f"Ответ сервера: {e.response.text}")
     except requests.exceptions.RequestException as e:
         st.error(f"Произошла ошибка при запросе к API: {str(e)}")
     
     return None
 
 def download_audio(url, filename):
-    """Скачивание аудио файла"""
-    response = requests.get(url)
-    return BytesIO(response.content)
+    """Скачивание аудио файла через дисковый кэш"""
+    return media_cache.get_cache().fetch(url)
+
+def display_analysis(analysis, track):
+    """Осциллограмма и параметры трека из сохраненного анализа, без повторного чтения аудио"""
+    st.area_chart(analysis['peaks'], height=80)
+    minutes, seconds = divmod(int(round(analysis['duration'])), 60)
+    parts = [f"Длительность: {minutes}:{seconds:02d}"]
+    if analysis.get('bpm'):
+        parts.append(f"темп ≈ {analysis['bpm']:.0f} BPM")
+    if analysis.get('loudness_lufs') is not None:
+        parts.append(f"громкость {analysis['loudness_lufs']:.1f} LUFS")
+    parts.append(f"RMS {analysis['rms_dbfs']:.1f} dBFS")
+    st.caption(", ".join(parts))
+    for problem in audio_analysis.mismatches(analysis, track):
+        st.warning(f"Не совпадает с запросом: {problem}")
 
 def display_track_info(track, index):
     """Отображение информации о треке"""
@@ -62,9 +89,11 @@ def display_track_info(track, index):
     with col1:
         image_url = track.get('image_url')
         if image_url:
-            st.image(image_url, caption="Обложка трека", use_column_width=True)
+            st.image(thumbnails.local_image(image_url, thumbnails.CARD_WIDTH), caption="Обложка трека", width="stretch")
     
     with col2:
+        if track.get('variant'):
+            st.write(f"Вариант: {track['variant']}")
         st.write(f"ID: {track.get('id', 'Не указан')}")
         st.write(f"Статус: {track.get('status', 'Не указан')}")
         st.write(f"Модель: {track.get('model_name', 'Не указана')}")
@@ -77,16 +106,20 @@ def display_track_info(track, index):
         
         audio_url = track.get('audio_url')
         if audio_url:
-            st.audio(audio_url, format='audio/wav')
+            # Играется облегченная версия; пока она готовится в фоне - отрывок или исходный URL
+            source, mime, kind = transcode.playback_source(audio_url)
+            st.audio(source, format=mime)
+            if kind == 'clip':
+                st.caption(f"Отрывок: первые {transcode.CLIP_SECONDS:.0f} секунд, полная облегченная версия готовится")
+            analysis = audio_analysis.for_url(audio_url)
+            if analysis:
+                display_analysis(analysis, track)
             
             audio_filename = f"generated_track_{index+1}.wav"
-            audio_file = download_audio(audio_url, audio_filename)
-            st.download_button(
-                label="Скачать трек",
-                data=audio_file,
-                file_name=audio_filename,
-                mime="audio/wav"
-            )
+            # Файл скачивается в кэш только по нажатию и отдается браузеру потоково, минуя память Streamlit
+            st.link_button("Скачать трек", zip_export.track_download_url(audio_url, audio_filename, st.context.url))
+        elif track.get('status') and track['status'] not in job_poller.FINAL_STATUSES:
+            st.info("Аудио еще генерируется...")
         else:
             st.warning("URL аудио не найден для этого трека.")
         
@@ -95,25 +128,195 @@ def display_track_info(track, index):
     
     st.markdown("---")  # Разделитель между треками
 
-def generate_prompt(base_prompt, genre, mood, voice_gender, additional_params):
-    """Генерация полного промпта на основе параметров"""
-    prompt_parts = [base_prompt]
-    
-    if genre:
-        prompt_parts.append(f"Genre: {genre}")
-    if mood:
-        prompt_parts.append(f"Mood: {mood}")
-    if voice_gender:
-        prompt_parts.append(f"Voice: {voice_gender}")
-    
-    for param, value in additional_params.items():
-        if value:
-            prompt_parts.append(f"{param}: {value}")
-    
-    return ". ".join(prompt_parts)
+@st.fragment
+def display_track_card(track, index):
+    """Карточка трека; действия внутри нее перезапускают только этот фрагмент"""
+    display_track_info(track, index)
+
+def build_export(tracks, key, total=None):
+    """Сборка ZIP-архива с индикатором прогресса; путь к архиву сохраняется в session_state[key]"""
+    bar = st.progress(0.0, text="Сборка архива...")
+
+    def progress(done):
+        text = f"Сборка архива: {done} из {total}" if total else f"Сборка архива: {done}"
+        bar.progress(min(done / total, 1.0) if total else 0.0, text=text)
+
+    st.session_state[key] = zip_export.export_zip(tracks, progress)
+    bar.empty()
+
+def display_export_download(key):
+    """Ссылка на собранный архив: файл отдается с диска потоково сервером архивов, минуя память Streamlit"""
+    path = st.session_state.get(key)
+    if path and os.path.exists(path):
+        st.link_button("Скачать ZIP", zip_export.download_url(path, st.context.url), key=f"{key}_download")
+
+def display_export(tracks):
+    """Скачивание всех или выбранных треков одним архивом с текстами, обложками и манифестом"""
+    with st.expander("Скачать все или выбранные треки (ZIP)"):
+        selected = st.multiselect(
+            "Треки (если ничего не выбрано - все)",
+            list(range(len(tracks))),
+            format_func=lambda i: f"{i+1}. {tracks[i].get('title') or 'Без названия'}",
+            key="export_selection"
+        )
+        chosen = [tracks[i] for i in selected] or tracks
+        if st.button(f"Собрать архив ({len(chosen)})", key="export_build"):
+            build_export(chosen, 'export_path', len(chosen))
+        display_export_download('export_path')
+
+def display_track_list(tracks):
+    """Постраничный вывод треков: на каждом перезапуске отрисовывается только текущая страница"""
+    pages = (len(tracks) + TRACKS_PER_PAGE - 1) // TRACKS_PER_PAGE
+    page = 1
+    if pages > 1:
+        page = st.number_input("Страница", min_value=1, max_value=pages, value=1, key="tracks_page")
+    first = (page - 1) * TRACKS_PER_PAGE
+    visible = tracks[first:first + TRACKS_PER_PAGE]
+
+    display_export(tracks)
+
+    prefetch.prefetch(track.get('audio_url') for track in visible)
+    for i, track in enumerate(visible):
+        display_track_card(track, first + i)
+
+def start_tracks(tracks, wait_audio):
+    """Показ новых треков; незавершенные передаются в фоновый опрос"""
+    st.session_state['tracks'] = tracks
+    st.session_state['tracks_pending'] = not wait_audio
+    st.session_state.pop('tracks_page', None)
+    st.session_state.pop('export_path', None)
+    st.session_state.pop('export_selection', None)
+    if not wait_audio:
+        job_poller.get_poller().submit(tracks)
+
+def generate_variants(variant_list, make_instrumental, wait_audio, fresh):
+    """Одновременная генерация всех вариантов; возвращает треки с подписью варианта"""
+    user = st.session_state.setdefault('user_id', str(uuid.uuid4()))
+
+    def submit(prompt):
+        return suno_api.submit_generation(prompt, make_instrumental, wait_audio, fresh=fresh, user=user)
+
+    with st.spinner(f"Генерация вариантов: {len(variant_list)}..."):
+        results = variants.generate_variants(variant_list, submit)
+
+    tracks = []
+    for variant in results:
+        if variant['error']:
+            st.error(f"Вариант «{variant['label']}»: {variant['error']}")
+            continue
+        for track in suno_api.extract_tracks(variant['result']):
+            tracks.append(dict(track, variant=variant['label']))
+    return tracks
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def display_pending_jobs():
+    """Автообновляемые карточки фоновых задач: название и текст, затем обложка и аудио появляются по мере готовности"""
+    tracks, pending = job_poller.refresh_tracks(st.session_state['tracks'])
+    st.session_state['tracks'] = tracks
+
+    if pending:
+        ready = sum(1 for track in tracks if track.get('audio_url'))
+        st.info(f"Музыка генерируется в фоновом режиме: готово треков {ready} из {len(tracks)}. "
+                "Треки появляются на странице по мере готовности.")
+        for i, track in enumerate(tracks):
+            display_track_info(track, i)
+    else:
+        # Все задачи завершены: перерисовываем страницу целиком
+        st.session_state['tracks_pending'] = False
+        st.rerun()
+
+def queue_owner():
+    """Владелец заданий в очереди; хранится в адресе страницы, чтобы задания находились после перезагрузки"""
+    if 'owner' not in st.query_params:
+        st.query_params['owner'] = st.session_state.setdefault('user_id', str(uuid.uuid4()))
+    return st.query_params['owner']
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def display_queued_jobs(owner):
+    """Автообновляемый статус заданий в очереди"""
+    jobs = job_queue.get_queue().jobs_for_owner(owner)
+    finished = sum(1 for job in jobs if job['status'] in job_queue.FINAL_STATUSES)
+    if finished != st.session_state.get('queue_finished'):
+        # Задание завершилось: перерисовываем страницу целиком, чтобы показать его треки
+        st.session_state['queue_finished'] = finished
+        st.rerun()
+
+    for job in jobs:
+        if job['status'] in job_queue.FINAL_STATUSES:
+            continue
+        st.write(f"Задание от {time.strftime('%H:%M:%S', time.localtime(job['created_at']))}: {job['status']}")
+        for track in job['tracks']:
+            st.write(f"— трек {track.get('id')}: {track.get('status', 'Не указан')}")
+
+def display_queue(owner):
+    """Задания пользователя из очереди: незавершенные обновляются, готовые показываются целиком"""
+    jobs = job_queue.get_queue().jobs_for_owner(owner)
+    if not jobs:
+        return
+    finished = [job for job in jobs if job['status'] in job_queue.FINAL_STATUSES]
+    st.session_state['queue_finished'] = len(finished)
+    if len(finished) < len(jobs):
+        st.info("Задания выполняются обработчиками очереди. Страница обновится автоматически.")
+        display_queued_jobs(owner)
+
+    st.subheader("Сгенерированные треки:")
+    index = 0
+    for job in finished:
+        if job['status'] == job_queue.FAILED:
+            st.error(f"Задание не выполнено: {job.get('error') or 'неизвестная ошибка'}")
+        for track in job['tracks']:
+            display_track_card(track, index)
+            index += 1
+
+def history_next_page(cursor):
+    st.session_state['history_cursors'].append(cursor)
+
+def history_previous_page():
+    st.session_state['history_cursors'].pop()
+
+def display_history():
+    """История всех генераций из библиотеки треков; загружается только видимая страница"""
+    st.title("История генераций")
+    library = track_library.get_library()
+
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        query = st.text_input("Поиск по тексту песни, промпту и тегам", key="history_query")
+    with col2:
+        status = st.selectbox("Статус", [""] + library.statuses(), key="history_status")
+
+    # При смене фильтров возвращаемся на первую страницу
+    if st.session_state.get('history_filters') != (query, status):
+        st.session_state['history_filters'] = (query, status)
+        st.session_state['history_cursors'] = [None]
+    cursors = st.session_state['history_cursors']
+
+    tracks, next_cursor = library.page(cursors[-1], status=status or None, query=query)
+    if not tracks:
+        st.info("Треков не найдено.")
+        return
+
+    with st.expander("Скачать всю историю по фильтру (ZIP)"):
+        if st.button("Собрать архив", key="history_export_build"):
+            build_export(library.iter_tracks(status=status or None, query=query), 'history_export_path')
+        display_export_download('history_export_path')
+
+    first = (len(cursors) - 1) * track_library.PAGE_SIZE
+    for i, track in enumerate(tracks):
+        display_track_card(track, first + i)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("← Новее", disabled=len(cursors) == 1, on_click=history_previous_page)
+    with col2:
+        st.button("Старее →", disabled=next_cursor is None, on_click=history_next_page, args=(next_cursor,))
 
 def main():
     st.set_page_config(page_title="AI Music Generator", layout="wide")
+
+    if st.sidebar.radio("Раздел", ["Генерация", "История"]) == "История":
+        display_history()
+        return
     
     st.title("AI Music Generator")
     st.write("Опишите музыку, которую вы хотите сгенерировать, и наш ИИ создаст ее для вас!")
@@ -125,16 +328,30 @@ def main():
         placeholder="Например: Create a relaxing ambient music track with piano and strings"
     )
     
-    with st.expander("Дополнительные параметры"):
+    variants_mode = st.checkbox("Несколько вариантов (выбрать несколько жанров, настроений, голосов или темпов)",
+                                value=False)
+
+    with st.expander("Дополнительные параметры", expanded=variants_mode):
         col1, col2 = st.columns(2)
+        genre_options = ["", "Pop", "Rock", "Classical", "Jazz", "Electronic", "Hip Hop", "Country", "R&B"]
+        mood_options = ["", "Happy", "Sad", "Energetic", "Calm", "Romantic", "Angry", "Mysterious"]
+        voice_options = ["", "Male", "Female", "Neutral"]
         
         with col1:
-            genre = st.selectbox("Жанр", ["", "Pop", "Rock", "Classical", "Jazz", "Electronic", "Hip Hop", "Country", "R&B"])
-            mood = st.selectbox("Настроение", ["", "Happy", "Sad", "Energetic", "Calm", "Romantic", "Angry", "Mysterious"])
+            if variants_mode:
+                genres = st.multiselect("Жанр", genre_options[1:])
+                moods = st.multiselect("Настроение", mood_options[1:])
+            else:
+                genre = st.selectbox("Жанр", genre_options)
+                mood = st.selectbox("Настроение", mood_options)
         
         with col2:
-            voice_gender = st.selectbox("Пол голоса", ["", "Male", "Female", "Neutral"])
-            tempo = st.slider("Темп (BPM)", 60, 200, 120)
+            if variants_mode:
+                voice_genders = st.multiselect("Пол голоса", voice_options[1:])
+                tempos = st.multiselect("Темп (BPM)", variants.TEMPO_OPTIONS)
+            else:
+                voice_gender = st.selectbox("Пол голоса", voice_options)
+                tempo = st.slider("Темп (BPM)", 60, 200, 120)
         
         additional_params = {
             "Instruments": st.text_input("Дополнительные инструменты"),
@@ -143,12 +360,21 @@ def main():
         }
     
     make_instrumental = st.checkbox("Сделать инструментальной", value=False)
-    wait_audio = st.checkbox("Ждать генерации аудио", value=True)
-    
-    full_prompt = generate_prompt(base_prompt, genre, mood, voice_gender, additional_params)
+    wait_audio = st.checkbox("Ждать генерации аудио", value=False)
+    fresh = st.checkbox("Новый вариант (не брать готовый результат для такого же запроса)", value=False)
     
-    st.subheader("Сгенерированный промпт:")
-    st.write(full_prompt)
+    if variants_mode:
+        variant_list = variants.expand_grid(generate_prompt, base_prompt, genres, moods, voice_genders,
+                                            additional_params, tempos)
+        full_prompt = variant_list[0]['prompt']
+        st.subheader(f"Варианты промпта ({len(variant_list)}):")
+        for variant in variant_list:
+            st.write(f"**{variant['label']}**: {variant['prompt']}")
+    else:
+        variant_list = []
+        full_prompt = generate_prompt(base_prompt, genre, mood, voice_gender, additional_params)
+        st.subheader("Сгенерированный промпт:")
+        st.write(full_prompt)
     
     generate_button = st.button("Сгенерировать музыку", type="primary")
 
@@ -156,25 +382,45 @@ def main():
         if not full_prompt.strip():
             st.error("Промпт не может быть пустым. Пожалуйста, введите описание желаемой музыки.")
             return
+        if len(variant_list) > variants.VARIANTS_BUDGET:
+            st.error(f"Слишком много вариантов: {len(variant_list)}. За один раз можно не больше "
+                     f"{variants.VARIANTS_BUDGET}, уменьшите число выбранных значений.")
+            return
         
-        result = generate_music_and_text(full_prompt, make_instrumental, wait_audio)
-        
-        if result:
-            if isinstance(result, list):
-                st.session_state['tracks'] = result
-            elif isinstance(result, dict):
-                st.session_state['tracks'] = [result]
-            else:
-                st.warning("Неожиданный формат ответа от API.")
-                return
+        if JOB_QUEUE_MODE:
+            for variant in variant_list or [{'prompt': full_prompt}]:
+                job_queue.get_queue().enqueue({"prompt": variant['prompt'], "make_instrumental": make_instrumental,
+                                               "fresh": fresh}, queue_owner())
+            st.success("Задание добавлено в очередь.")
+            display_queue(queue_owner())
+            return
+
+        if variants_mode:
+            tracks = generate_variants(variant_list, make_instrumental, wait_audio, fresh)
+            if tracks:
+                start_tracks(tracks, wait_audio)
         else:
-            st.error("Не удалось получить результаты генерации музыки. Пожалуйста, проверьте введенные данные и попробуйте еще раз.")
+            result = generate_music_and_text(full_prompt, make_instrumental, wait_audio, fresh)
 
-    if 'tracks' in st.session_state:
+            if result:
+                tracks = suno_api.extract_tracks(result)
+                if not tracks:
+                    st.warning("Неожиданный формат ответа от API.")
+                    return
+                start_tracks(tracks, wait_audio)
+            else:
+                st.error("Не удалось получить результаты генерации музыки. Пожалуйста, проверьте введенные данные и попробуйте еще раз.")
+
+    if JOB_QUEUE_MODE:
+        display_queue(queue_owner())
+    elif st.session_state.get('tracks_pending'):
+        display_pending_jobs()
+    elif 'tracks' in st.session_state:
         st.subheader("Сгенерированные треки:")
         
-        for i, track in enumerate(st.session_state['tracks']):
-            display_track_info(track, i)
+        display_track_list(st.session_state['tracks'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    metrics.start_exporters()
+    with metrics.rerun_timer("app2"):
+        main()
\ No newline at end of file
@@ -0,0 +1,373 @@
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import wave
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import media_cache
+import metrics
+import singleflight
+
+# Анализ скачанного аудио: пики для осциллограммы, громкость, длительность и темп
+AUDIO_ANALYSIS = os.getenv('AUDIO_ANALYSIS', '1') == '1'
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '2'))
+# Число точек осциллограммы
+WAVEFORM_POINTS = int(os.getenv('WAVEFORM_POINTS', '400'))
+# Допустимое отклонение темпа (доля) и длительности (доля, но не меньше DURATION_TOLERANCE_SECONDS)
+TEMPO_TOLERANCE = float(os.getenv('TEMPO_TOLERANCE', '0.08'))
+DURATION_TOLERANCE = float(os.getenv('DURATION_TOLERANCE', '0.15'))
+DURATION_TOLERANCE_SECONDS = float(os.getenv('DURATION_TOLERANCE_SECONDS', '10'))
+# Повтор анализа после ошибки: задержка удваивается с каждой неудачей до ANALYSIS_RETRY_MAX_DELAY
+ANALYSIS_RETRY_DELAY = float(os.getenv('ANALYSIS_RETRY_DELAY', '60'))
+ANALYSIS_RETRY_MAX_DELAY = float(os.getenv('ANALYSIS_RETRY_MAX_DELAY', '3600'))
+
+ANALYSIS_SUFFIX = ".analysis.json"
+ANALYSIS_VERSION = 1
+BPM_RANGE = (60, 200)
+# Минимальный скачок громкости между кадрами (в десятках дБ), чтобы считать его началом ноты
+MIN_ONSET = 0.05
+# Кадр огибающей - 10 мс, блок громкости - 100 мс (окно 400 мс с перекрытием 75%, ITU-R BS.1770)
+FRAMES_PER_SECOND = 100
+FRAMES_PER_BLOCK = 10
+BLOCKS_PER_CHUNK = 50
+# Формат, в который ffmpeg декодирует сжатые файлы
+FFMPEG_RATE = 44100
+FFMPEG_CHANNELS = 2
+
+ANALYSES = metrics.counter("audio_analysis_total", "Анализы аудио по результату")
+ANALYSIS_SECONDS = metrics.histogram("audio_analysis_seconds", "Длительность анализа одного файла")
+
+TEMPO_PATTERN = re.compile(r"Tempo:\s*(\d+(?:\.\d+)?)\s*BPM", re.IGNORECASE)
+DURATION_PATTERN = re.compile(r"Duration:\s*(\d+(?:\.\d+)?)\s*seconds", re.IGNORECASE)
+
+
+def _is_wav(path):
+    return path.lower().endswith(".wav")
+
+
+def audio_format(path):
+    """Частота дискретизации и число каналов"""
+    if not _is_wav(path):
+        return FFMPEG_RATE, FFMPEG_CHANNELS
+    try:
+        with wave.open(path, "rb") as source:
+            return source.getframerate(), source.getnchannels()
+    except wave.Error as e:
+        raise ValueError(f"Неподдерживаемый WAV: {e}")
+
+
+def wav_blocks(path, chunk_frames):
+    """Сэмплы WAV-файла кусками (frames x channels, float32 в [-1, 1])"""
+    with wave.open(path, "rb") as source:
+        channels, width = source.getnchannels(), source.getsampwidth()
+        if width not in (1, 2, 3, 4):
+            raise ValueError(f"Неподдерживаемая разрядность WAV: {width * 8} бит")
+        while True:
+            raw = source.readframes(chunk_frames)
+            if not raw:
+                return
+            if width == 1:
+                samples = (np.frombuffer(raw, np.uint8).astype(np.float32) - 128) / 128
+            elif width == 3:
+                # 24 бита: дополняем каждый сэмпл младшим нулевым байтом до int32
+                triples = np.frombuffer(raw, np.uint8).reshape(-1, 3)
+                padded = np.zeros((len(triples), 4), np.uint8)
+                padded[:, 1:] = triples
+                samples = padded.view("<i4").ravel().astype(np.float32) / 2 ** 31
+            else:
+                dtype = "<i2" if width == 2 else "<i4"
+                samples = np.frombuffer(raw, dtype).astype(np.float32) / 2 ** (width * 8 - 1)
+            yield samples.reshape(-1, channels)
+
+
+def _ffmpeg_blocks(path, chunk_frames, rate=FFMPEG_RATE, channels=FFMPEG_CHANNELS):
+    """Сэмплы сжатого файла (MP3 и т.п.) через ffmpeg, если он установлен"""
+    if not shutil.which("ffmpeg"):
+        raise ValueError("Для анализа этого формата нужен ffmpeg")
+    process = subprocess.Popen(["ffmpeg", "-v", "error", "-i", path, "-f", "s16le", "-ac", str(channels),
+                                "-ar", str(rate), "-"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            raw = process.stdout.read(chunk_frames * channels * 2)
+            if not raw:
+                break
+            raw = raw[:len(raw) - len(raw) % (channels * 2)]
+            yield (np.frombuffer(raw, "<i2").astype(np.float32) / 2 ** 15).reshape(-1, channels)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise ValueError("ffmpeg не смог декодировать файл")
+
+
+def _k_weighting(rate, size):
+    """Квадрат АЧХ K-фильтра BS.1770 (полка +4 дБ и ФВЧ ~38 Гц) на частотах rfft блока
+
+    Для громкости нужна только мощность, поэтому фильтр применяется в частотной области
+    одним умножением, без поэлементной рекурсии.
+    """
+    def biquad(b, a):
+        z = np.exp(-1j * 2 * np.pi * np.fft.rfftfreq(size, 1 / rate) / rate)
+        return np.abs((b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)) ** 2
+
+    gain, q, fc = 10 ** (4.0 / 40), 1 / np.sqrt(2), 1500.0
+    w0 = 2 * np.pi * fc / rate
+    alpha, cos, root = np.sin(w0) / (2 * q), np.cos(w0), np.sqrt(gain)
+    shelf = biquad(
+        (gain * ((gain + 1) + (gain - 1) * cos + 2 * root * alpha), -2 * gain * ((gain - 1) + (gain + 1) * cos),
+         gain * ((gain + 1) + (gain - 1) * cos - 2 * root * alpha)),
+        ((gain + 1) - (gain - 1) * cos + 2 * root * alpha, 2 * ((gain - 1) - (gain + 1) * cos),
+         (gain + 1) - (gain - 1) * cos - 2 * root * alpha)
+    )
+    q, fc = 0.5, 38.0
+    w0 = 2 * np.pi * fc / rate
+    alpha, cos = np.sin(w0) / (2 * q), np.cos(w0)
+    highpass = biquad(((1 + cos) / 2, -(1 + cos), (1 + cos) / 2), (1 + alpha, -2 * cos, 1 - alpha))
+    return shelf * highpass
+
+
+def _integrated_loudness(block_powers):
+    """Интегральная громкость (LUFS) по мощностям блоков 100 мс со стробированием BS.1770"""
+    if len(block_powers) < 4:
+        return None
+    # Окна 400 мс с шагом 100 мс
+    windows = np.convolve(block_powers, np.ones(4) / 4, mode="valid")
+    loudness = -0.691 + 10 * np.log10(np.maximum(windows, 1e-20))
+    gated = windows[loudness > -70]
+    if not len(gated):
+        return None
+    relative = -0.691 + 10 * np.log10(gated.mean()) - 10
+    gated = windows[(loudness > -70) & (loudness > relative)]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def _estimate_bpm(energy):
+    """Темп по автокорреляции огибающей начала нот (рост логарифма энергии кадров 10 мс)"""
+    if len(energy) < FRAMES_PER_SECOND * 4:
+        return None, 0.0
+    onset = np.maximum(np.diff(np.log10(energy + 1e-10)), 0)
+    if onset.max() < MIN_ONSET:
+        # Ровный звук без атак: темп не определяется
+        return None, 0.0
+    onset -= onset.mean()
+    size = 1 << int(np.ceil(np.log2(len(onset) * 2)))
+    spectrum = np.fft.rfft(onset, size)
+    correlation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(onset)]
+    if correlation[0] <= 0:
+        return None, 0.0
+    low, high = int(60 * FRAMES_PER_SECOND / BPM_RANGE[1]), int(np.ceil(60 * FRAMES_PER_SECOND / BPM_RANGE[0]))
+    lag = low + int(np.argmax(correlation[low:high + 1]))
+    # Уточнение положения пика параболой по соседним точкам
+    shift = 0.0
+    if low < lag < high:
+        left, center, right = correlation[lag - 1:lag + 2]
+        denominator = left - 2 * center + right
+        if denominator:
+            shift = 0.5 * (left - right) / denominator
+    return float(60 * FRAMES_PER_SECOND / (lag + shift)), float(correlation[lag] / correlation[0])
+
+
+def analyze_file(path, points=WAVEFORM_POINTS):
+    """Анализ аудиофайла за один проход кусками: пики, RMS, громкость, длительность, темп
+
+    Выполняется в процессе пула, поэтому не зависит от состояния вызывающего процесса.
+    """
+    rate, channels = audio_format(path)
+    frame = max(int(round(rate / FRAMES_PER_SECOND)), 1)
+    block = frame * FRAMES_PER_BLOCK
+    weighting = _k_weighting(rate, block)
+    blocks = wav_blocks if _is_wav(path) else _ffmpeg_blocks
+
+    peaks, energy, block_powers = [], [], []
+    total_frames, square_sum, peak = 0, 0.0, 0.0
+    for samples in blocks(path, block * BLOCKS_PER_CHUNK):
+        count = len(samples)
+        total_frames += count
+        square_sum += float(np.square(samples, dtype=np.float64).sum())
+        peak = max(peak, float(np.abs(samples).max()))
+
+        # Кадры 10 мс: максимум модуля для осциллограммы и энергия для темпа
+        usable = count - count % frame
+        if usable:
+            frames = samples[:usable].reshape(-1, frame, channels)
+            peaks.append(np.abs(frames).max(axis=(1, 2)))
+            energy.append(np.square(frames.mean(axis=2)).mean(axis=1))
+        # Блоки 100 мс: мощность после K-фильтра, сумма по каналам
+        usable = count - count % block
+        if usable:
+            spectrum = np.fft.rfft(samples[:usable].reshape(-1, block, channels), axis=1)
+            power = (np.abs(spectrum) ** 2 * weighting[None, :, None]).sum(axis=1)
+            # Теорема Парсеваля для rfft: все частоты, кроме 0 и Найквиста, входят дважды
+            power = 2 * power - np.abs(spectrum[:, 0]) ** 2 * weighting[0]
+            if block % 2 == 0:
+                power -= np.abs(spectrum[:, -1]) ** 2 * weighting[-1]
+            block_powers.append(power.sum(axis=1) / block ** 2)
+
+    if not total_frames:
+        raise ValueError("Файл не содержит аудио")
+    peaks = np.concatenate(peaks) if peaks else np.zeros(1)
+    energy = np.concatenate(energy) if energy else np.zeros(0)
+    block_powers = np.concatenate(block_powers) if block_powers else np.zeros(0)
+
+    # Осциллограмма: максимум в каждом из points интервалов
+    edges = np.linspace(0, len(peaks), min(points, len(peaks)) + 1).astype(int)
+    waveform = np.maximum.reduceat(peaks, edges[:-1]) if len(peaks) else peaks
+    rms = np.sqrt(square_sum / (total_frames * channels))
+    bpm, confidence = _estimate_bpm(energy)
+    return {
+        "version": ANALYSIS_VERSION,
+        "duration": total_frames / rate,
+        "sample_rate": rate,
+        "channels": channels,
+        "peak_dbfs": round(float(20 * np.log10(max(peak, 1e-10))), 2),
+        "rms_dbfs": round(float(20 * np.log10(max(rms, 1e-10))), 2),
+        "loudness_lufs": _round(_integrated_loudness(block_powers), 2),
+        "bpm": _round(bpm, 1),
+        "bpm_confidence": round(confidence, 3),
+        "peaks": [round(float(value), 3) for value in waveform]
+    }
+
+
+def _round(value, digits):
+    return round(value, digits) if value is not None else None
+
+
+def analysis_path(path):
+    """Файл с результатом анализа рядом с файлом в кэше"""
+    return media_cache.sidecar_path(path, ANALYSIS_SUFFIX)
+
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+def load(path):
+    """Сохраненный результат анализа файла или None"""
+    with _loaded_lock:
+        if path in _loaded:
+            _loaded.move_to_end(path)
+            return _loaded[path]
+    try:
+        with open(analysis_path(path), encoding="utf-8") as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if result.get("version") != ANALYSIS_VERSION:
+        return None
+    with _loaded_lock:
+        _loaded[path] = result
+        while len(_loaded) > 512:
+            _loaded.popitem(last=False)
+    return result
+
+
+_processes = None
+_threads = None
+_in_flight = set()
+# URL -> (число неудачных попыток подряд, когда можно повторить)
+_failed = {}
+_lock = threading.Lock()
+
+
+def _get_processes():
+    global _processes
+    with _lock:
+        if _processes is None:
+            # spawn: дочерние процессы не наследуют потоки и блокировки Streamlit/обработчика
+            _processes = ProcessPoolExecutor(max_workers=max(ANALYSIS_WORKERS, 1),
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _processes
+
+
+def analyze(path):
+    """Результат анализа файла из кэша; при отсутствии файл анализируется в пуле процессов"""
+    result = load(path)
+    if result is not None:
+        return result
+    with ANALYSIS_SECONDS.time():
+        try:
+            result = _get_processes().submit(analyze_file, path).result()
+        except Exception:
+            ANALYSES.inc(result="error")
+            raise
+    tmp_path = f"{analysis_path(path)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, analysis_path(path))
+    media_cache.get_cache().add_sidecar(analysis_path(path))
+    ANALYSES.inc(result="done")
+    return result
+
+
+def _fetch_and_analyze(url, path):
+    try:
+        if path is None:
+            path = singleflight.group("media").do(url, media_cache.get_cache().fetch, url)
+        analyze(path)
+        with _lock:
+            _failed.pop(url, None)
+    except Exception:
+        # Анализ необязателен: файл без результата показывается без осциллограммы до следующей попытки
+        with _lock:
+            failures = _failed.get(url, (0, 0.0))[0] + 1
+            delay = min(ANALYSIS_RETRY_DELAY * 2 ** (failures - 1), ANALYSIS_RETRY_MAX_DELAY)
+            _failed[url] = (failures, time.monotonic() + delay)
+    finally:
+        with _lock:
+            _in_flight.discard(url)
+
+
+def for_url(url):
+    """Результат анализа аудио по URL или None, пока он не готов (тогда анализ ставится в очередь)
+
+    Скачивание в кэш и анализ идут в фоне, по одной задаче на URL; после ошибки
+    повтор откладывается с растущей задержкой.
+    """
+    if not AUDIO_ANALYSIS or not url:
+        return None
+    path = media_cache.get_cache().lookup(url)
+    if path is not None:
+        result = load(path)
+        if result is not None:
+            return result
+    global _threads
+    with _lock:
+        failed = _failed.get(url)
+        if url in _in_flight or (failed and failed[1] > time.monotonic()):
+            return None
+        _in_flight.add(url)
+        if _threads is None:
+            _threads = ThreadPoolExecutor(max_workers=max(ANALYSIS_WORKERS, 1), thread_name_prefix="analysis")
+    _threads.submit(_fetch_and_analyze, url, path)
+    return None
+
+
+def requested_values(track):
+    """Темп и длительность, указанные в промпте генерации (или None)"""
+    text = " ".join(str(track.get(field) or "") for field in ("prompt", "gpt_description_prompt", "tags"))
+    tempo = TEMPO_PATTERN.search(text)
+    duration = DURATION_PATTERN.search(text)
+    return float(tempo.group(1)) if tempo else None, float(duration.group(1)) if duration else None
+
+
+def mismatches(analysis, track):
+    """Расхождения результата анализа с запрошенными темпом и длительностью"""
+    tempo, duration = requested_values(track)
+    problems = []
+    bpm = analysis.get("bpm")
+    # Половинный и двойной темп считаются совпадением: оценка темпа часто ошибается на октаву
+    if tempo and bpm and all(abs(bpm - candidate) > candidate * TEMPO_TOLERANCE
+                             for candidate in (tempo, tempo / 2, tempo * 2)):
+        problems.append(f"Темп ≈ {bpm:.0f} BPM, а запрошено {tempo:.0f} BPM")
+    actual = analysis.get("duration")
+    if duration and actual and abs(actual - duration) > max(duration * DURATION_TOLERANCE, DURATION_TOLERANCE_SECONDS):
+        problems.append(f"Длительность {actual:.0f} с, а запрошено {duration:.0f} с")
+    return problems
@@ -0,0 +1,187 @@
+"""Пакетная генерация музыки из файла JSONL или CSV без интерфейса Streamlit
+
+Пример:
+    python batch_generate.py prompts.jsonl --output-dir out --concurrency 4
+
+Каждая строка (или запись CSV) - параметры формы: prompt, genre, mood, voice_gender,
+instruments, era, language, duration, key, tempo, make_instrumental, а также необязательный id.
+Прогресс пишется в checkpoint.jsonl в каталоге результатов; повторный запуск
+пропускает готовые задания и не отправляет заново уже принятые API запросы.
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import job_poller
+import media_cache
+import metrics
+import suno_api
+import track_library
+from prompts import generate_prompt
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+WAIT_INTERVAL = 1.0
+
+TRUE_VALUES = {"1", "true", "yes", "да"}
+
+
+def read_specs(path):
+    """Чтение описаний треков из JSONL или CSV"""
+    specs = []
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    for index, row in enumerate(rows):
+        spec = dict(row)
+        spec["id"] = str(spec.get("id") or index + 1)
+        specs.append(spec)
+    return specs
+
+
+def build_prompt(spec):
+    """Полный промпт через тот же построитель, что и в интерфейсе"""
+    additional_params = {
+        "Instruments": spec.get("instruments", ""),
+        "Era": spec.get("era", ""),
+        "Language": spec.get("language", ""),
+        "Duration": f"{spec['duration']} seconds" if spec.get("duration") else "",
+        "Key": spec.get("key", ""),
+        "Tempo": f"{spec['tempo']} BPM" if spec.get("tempo") else ""
+    }
+    return generate_prompt(
+        (spec.get("prompt") or spec.get("base_prompt") or "").strip(),
+        spec.get("genre", ""),
+        spec.get("mood", ""),
+        spec.get("voice_gender", ""),
+        additional_params
+    )
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in TRUE_VALUES
+
+
+class Checkpoint:
+    """Журнал прогресса: принятые API задания и завершенные треки"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.submitted = {}
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Последняя строка могла не дописаться при аварийном завершении
+                        continue
+                    if record["stage"] == "submitted":
+                        self.submitted[record["spec_id"]] = record["job_ids"]
+                    elif record["stage"] == "done":
+                        self.done[record["spec_id"]] = record
+
+    def write(self, record):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def save_file(url, target_dir, name):
+    """Копирование файла из дискового кэша в каталог результатов"""
+    if not url:
+        return None
+    source = media_cache.get_cache().fetch(url)
+    target = os.path.join(target_dir, name + os.path.splitext(source)[1])
+    shutil.copyfile(source, target)
+    return target
+
+
+def run_spec(spec, checkpoint, output_dir, fresh=False):
+    """Генерация, ожидание и скачивание результатов одного задания"""
+    spec_id = spec["id"]
+    prompt = build_prompt(spec)
+    poller = job_poller.get_poller()
+
+    job_ids = checkpoint.submitted.get(spec_id)
+    if job_ids:
+        poller.submit(job_ids)
+    else:
+        result = suno_api.submit_generation(prompt, parse_bool(spec.get("make_instrumental")),
+                                            wait_audio=False, fresh=fresh, user="batch")
+        tracks = suno_api.extract_tracks(result)
+        job_ids = [track["id"] for track in tracks if track.get("id")]
+        if not job_ids:
+            raise ValueError("ID задачи не найден в ответе API")
+        checkpoint.write({"stage": "submitted", "spec_id": spec_id, "job_ids": job_ids})
+        poller.submit(tracks)
+
+    while not all(poller.is_finished(job_id) for job_id in job_ids):
+        time.sleep(WAIT_INTERVAL)
+
+    target_dir = os.path.join(output_dir, spec_id)
+    os.makedirs(target_dir, exist_ok=True)
+    tracks = []
+    for job_id in job_ids:
+        track = poller.get(job_id) or {"id": job_id, "status": "error"}
+        if track.get("status") == "complete":
+            track["audio_file"] = save_file(track.get("audio_url"), target_dir, job_id)
+            track["image_file"] = save_file(track.get("image_url"), target_dir, job_id + "_cover")
+        tracks.append(track)
+
+    track_library.get_library().record(tracks, prompt=prompt)
+    record = {"stage": "done", "spec_id": spec_id, "prompt": prompt, "tracks": tracks}
+    with open(os.path.join(target_dir, "result.json"), "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+    checkpoint.write(record)
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная генерация музыки через API Suno")
+    parser.add_argument("input", help="Файл с описаниями треков (.jsonl или .csv)")
+    parser.add_argument("--output-dir", default="batch_output", help="Каталог для результатов и аудио")
+    parser.add_argument("--concurrency", type=int, default=4, help="Сколько заданий выполнять одновременно")
+    parser.add_argument("--fresh", action="store_true", help="Не использовать сохраненные результаты одинаковых запросов")
+    args = parser.parse_args(argv)
+
+    metrics.start_exporters()
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(args.output_dir, CHECKPOINT_FILE))
+    specs = [spec for spec in read_specs(args.input) if spec["id"] not in checkpoint.done]
+    print(f"Заданий к выполнению: {len(specs)} (уже готово: {len(checkpoint.done)})")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        futures = {executor.submit(run_spec, spec, checkpoint, args.output_dir, args.fresh): spec for spec in specs}
+        for future in as_completed(futures):
+            spec_id = futures[future]["id"]
+            try:
+                record = future.result()
+                statuses = ", ".join(track.get("status", "?") for track in record["tracks"])
+                print(f"[{spec_id}] готово: {statuses}")
+            except Exception as e:
+                failed += 1
+                print(f"[{spec_id}] ошибка: {e}", file=sys.stderr)
+
+    if metrics.METRICS_DUMP_FILE:
+        metrics.dump()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""Сквозные замеры производительности на локальной заглушке API
+
+Запуск:
+    python benchmark.py --output bench_results.json
+    python benchmark.py --baseline bench_results.json --threshold 0.2
+
+Меряет задержку отправки generate_music/generate_music_and_text, время опроса
+fetch_music_details, скорость и пиковую память download_audio, а также время
+полного перезапуска main() с 1, 10, 100 и 1000 треками в st.session_state['tracks']
+(growth_ratio - во сколько раз перезапуск с 1000 треками медленнее, чем с одной страницей).
+С --baseline сравнивает результаты с сохраненными и возвращает код 1 при регрессии.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Метрики, для которых больше - лучше; для остальных лучше меньше
+HIGHER_IS_BETTER_SUFFIXES = ("_mb_s",)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(prefix, samples):
+    """p50/p95/среднее в миллисекундах"""
+    ms = [sample * 1000 for sample in samples]
+    return {
+        f"{prefix}.p50_ms": round(percentile(ms, 50), 3),
+        f"{prefix}.p95_ms": round(percentile(ms, 95), 3),
+        f"{prefix}.mean_ms": round(statistics.mean(ms), 3)
+    }
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def max_rss_mb():
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def bench_submit(iterations):
+    import app
+    import app2
+
+    results = {}
+    results.update(summarize("submit.generate_music", timed(
+        lambda: app.generate_music("benchmark prompt", "tag", "title", wait_audio=False, fresh=True), iterations)))
+    results.update(summarize("submit.generate_music_and_text", timed(
+        lambda: app2.generate_music_and_text("benchmark prompt", wait_audio=False, fresh=True), iterations)))
+    return results
+
+
+def bench_poll(iterations):
+    import app
+    import suno_api
+
+    tracks = suno_api.extract_tracks(suno_api.submit_generation("poll benchmark", wait_audio=False, fresh=True))
+    music_id = tracks[0]["id"]
+    return summarize("poll.fetch_music_details", timed(lambda: app.fetch_music_details(music_id), iterations))
+
+
+def bench_download(iterations):
+    import app2
+    import media_cache
+    import suno_api
+
+    results = {}
+    tracks = suno_api.extract_tracks(suno_api.submit_generation("download benchmark", wait_audio=True, fresh=True))
+    audio_url = tracks[0]["audio_url"]
+
+    samples = []
+    total_bytes = 0
+    rss_before = max_rss_mb()
+    tracemalloc.start()
+    for i in range(iterations):
+        # Каждый раз новый URL, чтобы скачивание не попадало в кэш
+        url = f"{audio_url}?n={i}-{time.time()}"
+        start = time.perf_counter()
+        path = app2.download_audio(url, "benchmark.wav")
+        samples.append(time.perf_counter() - start)
+        total_bytes += os.path.getsize(path)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results.update(summarize("download.download_audio", samples))
+    results["download.throughput_mb_s"] = round(total_bytes / (1024 * 1024) / sum(samples), 3)
+    results["download.file_mb"] = round(total_bytes / iterations / (1024 * 1024), 3)
+    results["download.python_peak_mb"] = round(traced_peak / (1024 * 1024), 3)
+    results["download.rss_growth_mb"] = round(max(max_rss_mb() - rss_before, 0.0), 3)
+
+    # Первое обращение скачивает файл в кэш, замеряются только повторные (попадания)
+    app2.download_audio(audio_url, "benchmark.wav")
+    cached = timed(lambda: app2.download_audio(audio_url, "benchmark.wav"), iterations)
+    results["download.cached_ms"] = round(statistics.mean(cached) * 1000, 3)
+    results["download.cache_hits"] = media_cache.get_cache().stats()["hits"]
+    return results
+
+
+def make_tracks(count, base_url):
+    return [{
+        "id": f"bench-{i}",
+        "title": f"Benchmark track {i}",
+        "status": "complete",
+        "model_name": "chirp-v3-5",
+        "created_at": "2024-01-01T00:00:00Z",
+        "lyric": "[Verse]\nla la la",
+        "audio_url": f"{base_url}/media/bench-{i}.wav",
+        "image_url": f"{base_url}/media/bench-{i}.png"
+    } for i in range(count)]
+
+
+def bench_rerun(script, counts, iterations, base_url):
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    prefix = f"rerun.{os.path.splitext(script)[0]}"
+    for count in counts:
+        at = AppTest.from_file(script, default_timeout=120)
+        at.session_state["tracks"] = make_tracks(count, base_url)
+        # Первый запуск прогревает кэши и импорт модулей
+        at.run()
+        if at.exception:
+            raise RuntimeError(f"{script}: {at.exception[0].value}")
+        results.update(summarize(f"{prefix}.tracks_{count}", timed(at.run, iterations)))
+
+    # Во сколько раз перезапуск с наибольшим числом треков медленнее, чем с одной полной страницей
+    # (при постраничном выводе в идеале ~1)
+    full_pages = [count for count in counts if count >= int(os.getenv('TRACKS_PER_PAGE', '10'))]
+    if len(full_pages) > 1:
+        smallest = results[f"{prefix}.tracks_{min(full_pages)}.p50_ms"]
+        largest = results[f"{prefix}.tracks_{max(full_pages)}.p50_ms"]
+        results[f"{prefix}.growth_ratio"] = round(largest / smallest, 3) if smallest else 0.0
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Список регрессий относительно базовых результатов"""
+    regressions = []
+    for name, value in results["metrics"].items():
+        base = baseline.get("metrics", {}).get(name)
+        if not isinstance(base, (int, float)) or not base or not name.endswith(("_ms", "_mb", "_mb_s")):
+            continue
+        if name.endswith(HIGHER_IS_BETTER_SUFFIXES):
+            change = (base - value) / base
+        else:
+            change = (value - base) / base
+        if change > threshold:
+            regressions.append({"metric": name, "baseline": base, "current": value, "change": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности AI Composer на локальной заглушке API")
+    parser.add_argument("--output", default="bench_results.json", help="Файл для результатов (JSON)")
+    parser.add_argument("--baseline", help="Файл с базовыми результатами для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое ухудшение (0.2 = 20%%)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--track-counts", default="1,10,100,1000")
+    parser.add_argument("--script", default="app2.py", help="Скрипт Streamlit для замера перезапусков")
+    parser.add_argument("--latency", type=float, default=0.01, help="Задержка ответов заглушки в секундах")
+    parser.add_argument("--audio-seconds", type=float, default=60)
+    args = parser.parse_args(argv)
+
+    # Заглушка и изолированные каталоги кэша настраиваются до импорта модулей приложения
+    import mock_suno_server
+    server = mock_suno_server.start_server(generation_delay=0, latency=args.latency, audio_seconds=args.audio_seconds)
+    workdir = tempfile.mkdtemp(prefix="ai_composer_bench_")
+    os.environ["SUNO_BASE_URL"] = server.base_url
+    os.environ.setdefault("SUNO_API_KEY", "benchmark")
+    os.environ["MEDIA_CACHE_DIR"] = os.path.join(workdir, "media")
+    os.environ["IDEMPOTENCY_DB"] = os.path.join(workdir, "idempotency.sqlite3")
+    os.environ["TRACK_LIBRARY_DB"] = os.path.join(workdir, "library.sqlite3")
+    os.environ["KEY_PINS_DB"] = os.path.join(workdir, "key_pins.sqlite3")
+    os.environ["JOB_QUEUE_DB"] = os.path.join(workdir, "jobs.sqlite3")
+    os.environ["EXPORT_DIR"] = os.path.join(workdir, "exports")
+
+    counts = [int(count) for count in args.track_counts.split(",") if count]
+    metrics = {}
+    metrics.update(bench_submit(args.iterations))
+    metrics.update(bench_poll(args.iterations))
+    metrics.update(bench_download(max(args.iterations // 4, 1)))
+    metrics.update(bench_rerun(args.script, counts, max(args.iterations // 4, 1), server.base_url))
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "mock_latency": args.latency,
+            "audio_seconds": args.audio_seconds
+        },
+        "metrics": metrics
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        results["regressions"] = compare(results, baseline, args.threshold)
+        exit_code = 1 if results["regressions"] else 0
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    for name, value in sorted(metrics.items()):
+        print(f"{name}: {value}")
+    for regression in results.get("regressions", []):
+        print(f"РЕГРЕССИЯ {regression['metric']}: {regression['baseline']} -> {regression['current']}")
+    print(f"Результаты сохранены в {args.output}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
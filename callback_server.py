@@ -0,0 +1,190 @@
+"""Приемник уведомлений о генерации - альтернатива опросу статуса
+
+Включается CALLBACK_MODE=1. К каждой фоновой генерации (wait_audio=False) добавляется
+callback_url, и API само сообщает о появлении результата. Треки из уведомления сразу
+попадают в поллер (job_poller.py), который будит ожидающие их обработчики, а опрос
+статуса остается запасным путем с редким интервалом POLL_CALLBACK_DELAY для задач,
+уведомление о которых не пришло (потеряно, приемник перезапускался и т.п.).
+
+Адрес приемника должен быть доступен со стороны API: за прокси или туннелем внешний
+адрес задается в CALLBACK_PUBLIC_URL. У каждого процесса свой приемник и свой порт
+(обработчики worker.py - CALLBACK_PORT + 1 + номер), поэтому внешний адрес должен
+содержать {port}; без него уведомления принимает только процесс с портом CALLBACK_PORT.
+Адрес всегда содержит секрет: CALLBACK_TOKEN или случайный, созданный при запуске процесса.
+Ссылки на файлы и итоговый статус из уведомлений не используются напрямую - поллер сразу
+запрашивает их у API (см. JobPoller.notify). Локально уведомления присылает mock_suno_server.py:
+    python mock_suno_server.py --port 8800
+    CALLBACK_MODE=1 SUNO_BASE_URL=http://127.0.0.1:8800 streamlit run app2.py
+"""
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import threading
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import metrics
+
+CALLBACK_MODE = os.getenv('CALLBACK_MODE', '0') == '1'
+CALLBACK_HOST = os.getenv('CALLBACK_HOST', '127.0.0.1')
+CALLBACK_PORT = int(os.getenv('CALLBACK_PORT', '8790'))
+# Внешний адрес приемника (без пути), если API обращается к нему не напрямую
+CALLBACK_PUBLIC_URL = os.getenv('CALLBACK_PUBLIC_URL', '')
+# Секрет в адресе уведомления, чтобы посторонний не мог отметить задачу готовой
+CALLBACK_TOKEN = os.getenv('CALLBACK_TOKEN') or secrets.token_urlsafe(24)
+CALLBACK_PATH = "/callback"
+MAX_BODY_SIZE = 4 * 1024 * 1024
+READ_TIMEOUT = 10
+
+CALLBACKS = metrics.counter("callback_requests_total", "Запросы к приемнику уведомлений по результату")
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large"}
+
+_listeners = []
+
+
+def register_listener(listener):
+    """Подписка на треки из уведомлений: listener(tracks) вызывается для каждого уведомления"""
+    _listeners.append(listener)
+
+
+def tracks_from_payload(payload):
+    """Треки из тела уведомления: список треков, один трек или обертка {"data": ...}"""
+    if isinstance(payload, list):
+        return [track for track in payload if isinstance(track, dict) and track.get("id")]
+    if isinstance(payload, dict):
+        if payload.get("id"):
+            return [payload]
+        return tracks_from_payload(payload.get("data"))
+    return []
+
+
+class CallbackServer:
+    """Асинхронный HTTP-приемник уведомлений в отдельном потоке со своим циклом событий"""
+
+    def __init__(self, host=CALLBACK_HOST, port=CALLBACK_PORT, public_url=CALLBACK_PUBLIC_URL, token=CALLBACK_TOKEN):
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self.token = token
+        self._loop = None
+        self._stop = None
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """Адрес, передаваемый API в callback_url"""
+        if self.public_url:
+            base = self.public_url.replace("{port}", str(self.port)).rstrip("/")
+        else:
+            base = f"http://{self.host}:{self.port}"
+        return base + CALLBACK_PATH + f"?{urlencode({'token': self.token})}"
+
+    def start(self):
+        """Запуск приемника; OSError, если порт занят"""
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), name="callback-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            return
+        # Порт 0 - свободный порт, выбранный системой
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._stop.wait()
+
+    async def _handle(self, reader, writer):
+        try:
+            status = await self._process(reader)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            status = 400
+        CALLBACKS.inc(result="accepted" if status == 200 else str(status))
+        body = json.dumps({"ok": status == 200}).encode("utf-8")
+        try:
+            writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _process(self, reader):
+        """Разбор запроса и передача треков подписчикам; возвращает код ответа"""
+        request_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        parsed = urlparse(target)
+        if method != "POST" or parsed.path != CALLBACK_PATH:
+            return 404
+        # Без секрета уведомления не принимаются вовсе
+        if not self.token or not hmac.compare_digest(parse_qs(parsed.query).get("token", [""])[0], self.token):
+            return 403
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_SIZE:
+            return 413
+        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+        tracks = tracks_from_payload(json.loads(body or b"null"))
+        for listener in _listeners:
+            listener(tracks)
+        return 200
+
+
+_server = None
+_server_failed = False
+_server_lock = threading.Lock()
+
+
+def get_server(port=CALLBACK_PORT):
+    """Общий для процесса приемник; None, если режим уведомлений выключен или порт занят"""
+    global _server, _server_failed
+    if not CALLBACK_MODE:
+        return None
+    if CALLBACK_PUBLIC_URL and "{port}" not in CALLBACK_PUBLIC_URL and port != CALLBACK_PORT:
+        # Внешний адрес ведет к приемнику другого процесса: задачи этого процесса остаются на опросе
+        return None
+    with _server_lock:
+        if _server is None and not _server_failed:
+            try:
+                _server = CallbackServer(port=port).start()
+            except OSError:
+                # Порт занят другим процессом: задачи этого процесса остаются на опросе статуса
+                _server_failed = True
+    return _server
+
+
+def callback_url():
+    """Адрес для callback_url в запросе генерации или None"""
+    server = get_server()
+    return server.url if server else None
+
+
+def is_running():
+    """Принимает ли процесс уведомления"""
+    return _server is not None
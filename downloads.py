@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+import http_client
+import metrics
+import resilience
+
+# Размер куска при потоковой записи в файл
+CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+# Число попыток докачки при обрыве соединения
+DOWNLOAD_RESUME_ATTEMPTS = int(os.getenv('DOWNLOAD_RESUME_ATTEMPTS', '3'))
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
+
+DOWNLOAD_SECONDS = metrics.histogram("download_seconds", "Длительность скачивания файлов")
+DOWNLOAD_REQUESTS = metrics.counter("download_requests_total", "Скачивания по типу файла и коду ответа")
+DOWNLOAD_BYTES = metrics.counter("download_bytes_total", "Объем скачанных данных")
+DOWNLOAD_RETRIES = metrics.counter("download_retries_total", "Повторные попытки (докачка) при обрыве")
+
+# Блокировка и число ее пользователей по пути файла; запись удаляется вместе с последним пользователем
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _path_lock(path):
+    """Блокировка, чтобы один файл не скачивался параллельно в нескольких потоках"""
+    with _locks_guard:
+        entry = _locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _locks[path]
+
+
+def media_kind(url):
+    """Тип файла для метрик: обложка или аудио"""
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return "image" if ext in IMAGE_EXTENSIONS else "audio"
+
+
+def _get(url, headers):
+    """GET через предохранитель файлового хранилища; медленный ответ может дублироваться"""
+    breaker = resilience.get_breaker("media")
+    breaker.before()
+    try:
+        response = resilience.hedged(lambda: http_client.get(url, headers=headers, stream=True),
+                                     resilience.HEDGE_DOWNLOAD_AFTER, "download", discard=lambda r: r.close())
+    except requests.exceptions.RequestException as e:
+        if resilience.is_transient(e):
+            breaker.failure()
+        else:
+            breaker.success()
+        raise
+    if response.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    return response
+
+
+def download(url, path, headers=None):
+    """Скачивание в path; возвращает (код ответа, заголовки ответа)
+
+    При условном запросе (If-None-Match/If-Modified-Since) и ответе 304 файл не создается.
+    """
+    with _path_lock(path):
+        if os.path.exists(path):
+            return 200, {}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + ".part"
+        status, response_headers = 200, {}
+        kind = media_kind(url)
+        received = 0
+        start = time.perf_counter()
+
+        for attempt in range(DOWNLOAD_RESUME_ATTEMPTS + 1):
+            if attempt:
+                DOWNLOAD_RETRIES.inc(kind=kind)
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            request_headers = dict(headers or {})
+            if offset:
+                request_headers["Range"] = f"bytes={offset}-"
+
+            try:
+                with _get(url, request_headers) as response:
+                    status, response_headers = response.status_code, response.headers
+                    if response.status_code == 304:
+                        DOWNLOAD_REQUESTS.inc(kind=kind, status="304")
+                        DOWNLOAD_SECONDS.observe(time.perf_counter() - start, kind=kind)
+                        return status, response_headers
+                    if response.status_code == 416 and offset:
+                        # Файл уже докачан полностью
+                        break
+                    response.raise_for_status()
+                    # 206 - сервер продолжил с нужного места, иначе начинаем заново
+                    mode = "ab" if offset and response.status_code == 206 else "wb"
+                    with open(part, mode) as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            received += len(chunk)
+                break
+            except requests.exceptions.RequestException as e:
+                # Обрывы, таймауты и 5xx повторяются с задержкой, остальные ошибки - сразу наружу
+                if attempt == DOWNLOAD_RESUME_ATTEMPTS or not resilience.is_transient(e):
+                    is_http_error = isinstance(e, requests.exceptions.HTTPError)
+                    DOWNLOAD_REQUESTS.inc(kind=kind, status=str(status) if is_http_error else "error")
+                    raise
+                time.sleep(resilience.backoff_delay(attempt))
+
+        os.replace(part, path)
+        DOWNLOAD_REQUESTS.inc(kind=kind, status=str(status))
+        DOWNLOAD_BYTES.inc(received, kind=kind)
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - start, kind=kind)
+        return status, response_headers
+
@@ -0,0 +1,107 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import metrics
+
+# Загрузка переменных окружения из файла .env
+load_dotenv()
+
+SUNO_API_KEY = os.getenv('SUNO_API_KEY')
+
+# Настройки пула соединений и таймаутов (секунды)
+POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '20'))
+POOL_BLOCK = os.getenv('HTTP_POOL_BLOCK', '0') == '1'
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+# При wait_audio=True API держит запрос открытым до конца генерации
+WAIT_AUDIO_READ_TIMEOUT = float(os.getenv('HTTP_WAIT_AUDIO_TIMEOUT', '600'))
+
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def api_headers(api_key=SUNO_API_KEY):
+    """Заголовки для запросов к API Suno"""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+
+def get_session():
+    """Общая для процесса сессия с keep-alive и пулом соединений"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_connections - число хостов, pool_maxsize - соединений на один хост
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_CONNECTIONS,
+                    pool_maxsize=POOL_MAXSIZE,
+                    pool_block=POOL_BLOCK
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def generate_timeout(wait_audio):
+    """Таймаут запроса генерации в зависимости от режима ожидания аудио"""
+    if wait_audio:
+        return (CONNECT_TIMEOUT, WAIT_AUDIO_READ_TIMEOUT)
+    return DEFAULT_TIMEOUT
+
+
+def get(url, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """GET через общую сессию"""
+    return get_session().get(url, timeout=timeout, **kwargs)
+
+
+def connection_stats():
+    """Статистика переиспользования соединений по всем хостам"""
+    session = get_session()
+    requests_total = 0
+    connections_total = 0
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_total += pool.num_requests
+            connections_total += pool.num_connections
+
+    reused = max(requests_total - connections_total, 0)
+    return {
+        "requests": requests_total,
+        "connections": connections_total,
+        "reused": reused,
+        "reuse_ratio": reused / requests_total if requests_total else 0.0
+    }
+
+
+def _collect():
+    if _session is None:
+        return []
+    stats = connection_stats()
+    return [
+        ("http_pool_requests_total", "Запросы через общий пул соединений", "counter", {}, stats["requests"]),
+        ("http_pool_connections_total", "Открытые пулом соединения", "counter", {}, stats["connections"]),
+        ("http_pool_reuse_ratio", "Доля запросов по уже открытому соединению", "gauge", {}, stats["reuse_ratio"])
+    ]
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Хранилище результатов одинаковых запросов на генерацию
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', os.path.join(tempfile.gettempdir(), 'ai_composer_idempotency.sqlite3'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at);
+"""
+
+
+def normalize_prompt(prompt):
+    """Нормализация промпта: регистр и пробелы не влияют на ключ"""
+    return " ".join((prompt or "").split()).casefold()
+
+
+def request_key(endpoint, prompt, make_instrumental, wait_audio, tags=None, title=None):
+    """Ключ идемпотентности запроса на генерацию"""
+    parts = {
+        "endpoint": endpoint,
+        "prompt": normalize_prompt(prompt),
+        "make_instrumental": bool(make_instrumental),
+        "wait_audio": bool(wait_audio),
+        "tags": normalize_prompt(tags),
+        "title": normalize_prompt(title)
+    }
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """Результаты генерации в SQLite с ограниченным сроком жизни"""
+
+    def __init__(self, path=IDEMPOTENCY_DB, ttl=IDEMPOTENCY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """Сохраненный результат или None, если его нет или он устарел"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT result FROM results WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        with self._lock:
+            self._stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, result):
+        """Сохранение результата и удаление устаревших записей"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, result, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now)
+            )
+            conn.execute("DELETE FROM results WHERE created_at <= ?", (now - self.ttl,))
+
+    def delete(self, key):
+        """Удаление сохраненного результата (например, задача завершилась ошибкой)"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            return dict(self._stats)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Общий для процесса экземпляр IdempotencyStore"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = IdempotencyStore()
+    return _store
@@ -0,0 +1,288 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import callback_server
+import key_pool
+import metrics
+import suno_api
+
+# Настройки опроса статуса (секунды)
+POLL_INITIAL_DELAY = float(os.getenv('POLL_INITIAL_DELAY', '2'))
+POLL_MAX_DELAY = float(os.getenv('POLL_MAX_DELAY', '30'))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', '1.5'))
+POLL_JITTER = float(os.getenv('POLL_JITTER', '0.3'))
+POLL_TIMEOUT = float(os.getenv('POLL_TIMEOUT', '900'))
+# Когда процесс принимает уведомления (callback_server.py), опрос нужен только как запасной путь
+POLL_CALLBACK_DELAY = float(os.getenv('POLL_CALLBACK_DELAY', '30'))
+# Максимум ID задач в одном запросе статуса (ids[0]..ids[n])
+POLL_BATCH_SIZE = int(os.getenv('POLL_BATCH_SIZE', '20'))
+# Задачи, срок опроса которых наступит в пределах окна, опрашиваются вместе с текущей пачкой
+POLL_COALESCE_WINDOW = float(os.getenv('POLL_COALESCE_WINDOW', '1'))
+# Сколько хранить завершенные задачи после окончания
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', '3600'))
+# Пауза после непредвиденной ошибки цикла опроса (например, база привязок ключей занята)
+POLL_ERROR_DELAY = float(os.getenv('POLL_ERROR_DELAY', '5'))
+
+FINAL_STATUSES = {"complete", "error"}
+# Очередь ограничителя запросов, в которой стоит фоновый опрос
+POLLER_USER = "poller"
+
+logger = logging.getLogger(__name__)
+
+
+class JobPoller:
+    """Фоновый пакетный опрос статуса задач всех сессий с экспоненциальной задержкой"""
+
+    def __init__(self, fetch=suno_api.fetch_details, batch_size=POLL_BATCH_SIZE):
+        self._fetch = fetch
+        self._batch_size = max(batch_size, 1)
+        self._jobs = {}
+        self._stats = {"requests": 0, "jobs_polled": 0, "callbacks": 0, "loop_errors": 0}
+        self._lock = threading.Lock()
+        # Сигнал об обновлении задач для ожидающих в wait()
+        self._changed = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def submit(self, tracks):
+        """Добавление задач в опрос (треки из ответа API или их ID)"""
+        now = time.monotonic()
+        initial_delay = POLL_CALLBACK_DELAY if callback_server.is_running() else POLL_INITIAL_DELAY
+        with self._lock:
+            for track in tracks:
+                if isinstance(track, str):
+                    track = {"id": track}
+                job_id = track.get("id")
+                if not job_id or job_id in self._jobs:
+                    continue
+                self._jobs[job_id] = {
+                    "track": dict(track),
+                    "error": None,
+                    "initial_delay": initial_delay,
+                    "delay": initial_delay,
+                    "next_poll": now + initial_delay,
+                    "updates": 0,
+                    "deadline": now + POLL_TIMEOUT,
+                    "finished_at": now if track.get("status") in FINAL_STATUSES else None
+                }
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def notify(self, tracks):
+        """Обновление задач из уведомления о генерации
+
+        Ссылки на файлы и итоговый статус берутся только из ответа API: если они есть
+        в уведомлении, задача сразу ставится в опрос, а из уведомления применяются
+        остальные поля (название, текст, промежуточный статус).
+        """
+        now = time.monotonic()
+        poll_now = False
+        with self._lock:
+            for track in tracks:
+                job = self._jobs.get(track.get("id"))
+                if job is None or job["finished_at"] is not None:
+                    continue
+                self._stats["callbacks"] += 1
+                safe = {key: value for key, value in track.items() if not key.endswith("_url") and key != "status"}
+                if track.get("status") not in FINAL_STATUSES and track.get("status"):
+                    safe["status"] = track["status"]
+                self._update(job, safe, None, now)
+                if len(safe) < len(track):
+                    job["next_poll"] = now
+                    poll_now = True
+        if poll_now:
+            self._wakeup.set()
+
+    def wait(self, job_ids, timeout):
+        """Ожидание обновления любой из задач (ответ опроса или уведомление) не дольше timeout"""
+        with self._changed:
+            before = self._versions(job_ids)
+            self._changed.wait_for(lambda: self._versions(job_ids) != before, timeout)
+
+    def _versions(self, job_ids):
+        return [self._jobs[job_id]["updates"] if job_id in self._jobs else None for job_id in job_ids]
+
+    def get(self, job_id):
+        """Текущее состояние трека задачи или None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            track = dict(job["track"])
+            if job["error"] and not track.get("error_message"):
+                track["error_message"] = job["error"]
+            return track
+
+    def is_finished(self, job_id):
+        """Завершена ли задача (успешно или с ошибкой)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job is None or job["finished_at"] is not None
+
+    def stats(self):
+        """Счетчики запросов статуса и опрошенных задач"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = sum(1 for job in self._jobs.values() if job["finished_at"] is None)
+        return stats
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="job-poller", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._run_once()
+            except Exception:
+                # Поток опроса один на процесс: ошибка итерации не должна его останавливать
+                logger.exception("Ошибка цикла опроса статуса, повтор через %s с", POLL_ERROR_DELAY)
+                with self._lock:
+                    self._stats["loop_errors"] += 1
+                time.sleep(POLL_ERROR_DELAY)
+
+    def _run_once(self):
+        due, wait = self._due_jobs()
+        # Статус запрашивается ключом, создавшим задачу, поэтому в пачку попадают задачи одного ключа
+        by_key = {}
+        pool = key_pool.get_pool()
+        for job_id in due:
+            by_key.setdefault(pool.for_job(job_id).name, []).append(job_id)
+        # Все ожидающие задачи всех сессий опрашиваются пачками
+        for job_ids in by_key.values():
+            for start in range(0, len(job_ids), self._batch_size):
+                self._poll(job_ids[start:start + self._batch_size])
+        if not due:
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _due_jobs(self):
+        now = time.monotonic()
+        due = []
+        upcoming = []
+        wait = POLL_MAX_DELAY
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job["finished_at"] is not None:
+                    if now - job["finished_at"] > JOB_RETENTION:
+                        del self._jobs[job_id]
+                    continue
+                if now >= job["deadline"]:
+                    # Срок истекает и тогда, когда опрос не удается даже отправить
+                    self._update(job, None, job["error"], now)
+                    continue
+                if job["next_poll"] <= now:
+                    due.append(job_id)
+                else:
+                    if job["next_poll"] <= now + POLL_COALESCE_WINDOW:
+                        upcoming.append(job_id)
+                    wait = min(wait, job["next_poll"] - now)
+        if not due:
+            return due, wait
+        return due + upcoming, wait
+
+    def _poll(self, job_ids):
+        try:
+            tracks = suno_api.extract_tracks(self._fetch(job_ids, user=POLLER_USER))
+            error = None
+        except Exception as e:
+            tracks = []
+            error = str(e)
+
+        by_id = {track.get("id"): track for track in tracks}
+        now = time.monotonic()
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["jobs_polled"] += len(job_ids)
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                self._update(job, by_id.get(job_id), error, now)
+
+    def _update(self, job, track, error, now):
+        """Применение нового состояния задачи (вызывается под self._lock)"""
+        before = dict(job["track"]), job["error"]
+        if track:
+            job["track"].update(track)
+        job["error"] = error
+        self._schedule(job, now, progressed=job["track"].get("status") != before[0].get("status"))
+        if (job["track"], job["error"]) != before or job["finished_at"] is not None:
+            job["updates"] += 1
+            self._changed.notify_all()
+
+    def _schedule(self, job, now, progressed=False):
+        """Планирование следующего опроса: экспоненциальная задержка со случайным разбросом
+
+        После смены статуса (например, queued → streaming) задержка сбрасывается к начальной,
+        чтобы следующая часть результата (обложка, аудио) появилась в интерфейсе быстрее.
+        """
+        if job["track"].get("status") in FINAL_STATUSES:
+            job["finished_at"] = now
+            return
+        if now >= job["deadline"]:
+            job["finished_at"] = now
+            job["track"]["status"] = "error"
+            job["error"] = job["error"] or "Превышено время ожидания генерации"
+            return
+        job["delay"] = job["initial_delay"] if progressed else min(job["delay"] * POLL_BACKOFF, POLL_MAX_DELAY)
+        jitter = job["delay"] * random.uniform(-POLL_JITTER, POLL_JITTER)
+        job["next_poll"] = now + max(job["delay"] + jitter, 0.1)
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    """Общий для процесса экземпляр JobPoller"""
+    global _poller
+    if _poller is None:
+        with _poller_lock:
+            if _poller is None:
+                _poller = JobPoller()
+    return _poller
+
+
+def _collect():
+    if _poller is None:
+        return []
+    stats = _poller.stats()
+    return [
+        ("job_poller_requests_total", "Пакетные запросы статуса", "counter", {}, stats["requests"]),
+        ("job_poller_jobs_polled_total", "Задачи, опрошенные во всех пакетах", "counter", {}, stats["jobs_polled"]),
+        ("job_poller_callbacks_total", "Обновления задач из уведомлений", "counter", {}, stats["callbacks"]),
+        ("job_poller_loop_errors_total", "Ошибки цикла опроса", "counter", {}, stats["loop_errors"]),
+        ("job_poller_pending_jobs", "Незавершенные задачи в опросе", "gauge", {}, stats["pending"])
+    ]
+
+
+metrics.register_collector(_collect)
+
+
+def _on_callback(tracks):
+    get_poller().notify(tracks)
+
+
+callback_server.register_listener(_on_callback)
+
+
+def refresh_tracks(tracks):
+    """Обновление списка треков из поллера; возвращает (треки, есть_незавершенные)"""
+    poller = get_poller()
+    updated = []
+    pending = False
+    for track in tracks:
+        job_id = track.get("id")
+        current = poller.get(job_id) if job_id else None
+        if current is not None:
+            track = current
+            if not poller.is_finished(job_id):
+                pending = True
+        updated.append(track)
+    return updated, pending
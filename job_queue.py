@@ -0,0 +1,198 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import metrics
+
+# Очередь заданий генерации, общая для интерфейса и процессов worker.py
+JOB_QUEUE_DB = os.getenv('JOB_QUEUE_DB', os.path.join(tempfile.gettempdir(), 'ai_composer_jobs.sqlite3'))
+# Задание принадлежит обработчику, пока тот продлевает аренду; иначе его подхватит другой
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', '10'))
+
+QUEUED = "queued"
+GENERATING = "generating"
+POLLING = "polling"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+
+ACTIVE_STATUSES = (GENERATING, POLLING, DOWNLOADING)
+FINAL_STATUSES = (DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    tracks TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_owner_created_at ON jobs (owner, created_at);
+"""
+
+
+def _row_to_job(row):
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["tracks"] = json.loads(job["tracks"]) if job["tracks"] else []
+    return job
+
+
+class JobQueue:
+    """Надежная очередь заданий в SQLite: интерфейс добавляет задания и читает их состояние,
+    обработчики забирают задания с арендой и записывают прогресс"""
+
+    def __init__(self, path=JOB_QUEUE_DB):
+        self.path = path
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _connect(self, immediate=False):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # BEGIN IMMEDIATE сразу берет блокировку записи, чтобы два обработчика не забрали одно задание
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def enqueue(self, params, owner):
+        """Добавление задания; params - аргументы suno_api.submit_generation"""
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, owner, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, owner, QUEUED, json.dumps(params, ensure_ascii=False), now, now)
+            )
+        return job_id
+
+    def claim(self, worker, lease=JOB_LEASE_SECONDS):
+        """Взять следующее задание: из очереди или брошенное обработчиком с истекшей арендой"""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            while True:
+                row = conn.execute(
+                    f"""SELECT * FROM jobs
+                        WHERE (status = ? AND not_before <= ?)
+                           OR (status IN ({",".join("?" * len(ACTIVE_STATUSES))}) AND lease_until < ?)
+                        ORDER BY created_at LIMIT 1""",
+                    (QUEUED, now, *ACTIVE_STATUSES, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == QUEUED or row["attempts"] < JOB_MAX_ATTEMPTS:
+                    break
+                # Обработчики несколько раз прерывались на этом задании: больше его не берем
+                conn.execute("UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL, "
+                             "updated_at = ? WHERE id = ?",
+                             (FAILED, row["error"] or "Обработка прерывалась слишком много раз", now, row["id"]))
+            # Задание с уже принятыми API треками продолжается с опроса, а не генерируется заново
+            status = row["status"] if row["status"] != QUEUED else (POLLING if row["tracks"] else GENERATING)
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                (status, worker, now + lease, now, row["id"])
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return _row_to_job(row)
+
+    def update(self, job_id, worker, status=None, tracks=None, error=None, lease=JOB_LEASE_SECONDS):
+        """Запись прогресса с продлением аренды; False - задание уже забрал другой обработчик"""
+        now = time.time()
+        fields = {"lease_until": now + lease, "updated_at": now}
+        if status is not None:
+            fields["status"] = status
+        if tracks is not None:
+            fields["tracks"] = json.dumps(tracks, ensure_ascii=False)
+        if error is not None:
+            fields["error"] = error
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ? AND worker = ?",
+                                  (*fields.values(), job_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error, max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY):
+        """Ошибка обработки: задание возвращается в очередь, пока не исчерпаны попытки"""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ?", (job_id, worker)).fetchone()
+            if row is None:
+                return
+            status = QUEUED if row["attempts"] < max_attempts else FAILED
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL, not_before = ?, "
+                "updated_at = ? WHERE id = ?",
+                (status, error, now + retry_delay, now, job_id)
+            )
+
+    def get(self, job_id):
+        """Состояние задания или None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def jobs_for_owner(self, owner, limit=20):
+        """Последние задания пользователя"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE owner = ? ORDER BY created_at DESC LIMIT ?",
+                                (owner, limit)).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def stats(self):
+        """Число заданий по статусам"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Общий для процесса экземпляр JobQueue"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
+
+
+def _collect():
+    if _queue is None:
+        return []
+    return [("job_queue_jobs", "Задания в очереди по статусам", "gauge", {"status": status}, count)
+            for status, count in _queue.stats().items()]
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,241 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+
+import http_client
+import metrics
+import resilience
+
+# Ключи и адреса API через запятую; при одинаковом числе ключ i работает с адресом i,
+# один адрес используется всеми ключами, один ключ - всеми адресами
+SUNO_API_KEYS = os.getenv('SUNO_API_KEYS', '')
+SUNO_BASE_URLS = os.getenv('SUNO_BASE_URLS', '')
+DEFAULT_BASE_URL = os.getenv('SUNO_BASE_URL', "https://api.aimlapi.com")
+# Квота генераций на один ключ за окно (0 - без ограничения)
+KEY_QUOTA = int(os.getenv('SUNO_KEY_QUOTA', '0'))
+KEY_QUOTA_WINDOW = float(os.getenv('SUNO_KEY_QUOTA_WINDOW', str(24 * 3600)))
+# Пауза для ключа после ответа 429, если сервер не прислал Retry-After
+KEY_COOLDOWN = float(os.getenv('SUNO_KEY_COOLDOWN', '30'))
+# Сколько генерация может ждать, пока с какого-нибудь ключа снимется пауза
+KEY_WAIT_TIMEOUT = float(os.getenv('SUNO_KEY_WAIT_TIMEOUT', '300'))
+# Привязка задач к ключу, который их создал (нужна для опроса статуса)
+KEY_PINS_DB = os.getenv('KEY_PINS_DB', os.path.join(tempfile.gettempdir(), 'ai_composer_key_pins.sqlite3'))
+KEY_PINS_TTL = float(os.getenv('KEY_PINS_TTL', str(7 * 24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pins (
+    job_id TEXT PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pins_created_at ON pins (created_at);
+"""
+
+
+# Классы запросов с отдельными предохранителями
+ENDPOINT_KINDS = ("generate", "status")
+
+
+class NoKeyAvailable(requests.exceptions.RequestException):
+    """Все ключи исчерпали квоту, на паузе после 429 или недоступны"""
+
+
+def _split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class ApiEndpoint:
+    """Ключ API вместе с адресом, через который он используется"""
+
+    def __init__(self, name, key, base_url):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.headers = http_client.api_headers(key)
+        # Долгие генерации с wait_audio и короткие опросы статуса не делят пробный запрос предохранителя
+        self.breakers = {kind: resilience.get_breaker(f"suno_api/{name}/{kind}") for kind in ENDPOINT_KINDS}
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.used = deque()
+        self.stats = {"requests": 0, "generations": 0, "throttled": 0}
+
+    def quota_used(self, now):
+        while self.used and self.used[0] <= now - KEY_QUOTA_WINDOW:
+            self.used.popleft()
+        return len(self.used)
+
+    def is_available(self, now):
+        if now < self.cooldown_until or self.breakers["generate"].state == resilience.OPEN:
+            return False
+        return not KEY_QUOTA or self.quota_used(now) < KEY_QUOTA
+
+    def load(self, now):
+        """Загрузка для выбора ключа: выполняющиеся запросы, доля израсходованной квоты, число генераций за окно"""
+        used = self.quota_used(now)
+        return self.in_flight, used / KEY_QUOTA if KEY_QUOTA else 0.0, used
+
+
+class KeyPool:
+    """Распределение генераций по ключам API и привязка задач к создавшему их ключу"""
+
+    def __init__(self, endpoints, pins_path=KEY_PINS_DB):
+        if not endpoints:
+            raise ValueError("Не задан ни один ключ API")
+        self.endpoints = {endpoint.name: endpoint for endpoint in endpoints}
+        self.default = endpoints[0]
+        self.pins_path = pins_path
+        self._pins = {}
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.pins_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def choose(self, timeout=KEY_WAIT_TIMEOUT):
+        """Наименее загруженный доступный ключ для новой генерации
+
+        Если все ключи на паузе после 429, ожидает окончания ближайшей паузы (не дольше timeout).
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                available = [endpoint for endpoint in self.endpoints.values() if endpoint.is_available(now)]
+                if available:
+                    return min(available, key=lambda endpoint: endpoint.load(now))
+                cooling = [endpoint.cooldown_until - now for endpoint in self.endpoints.values()
+                           if endpoint.cooldown_until > now]
+            # Ждать имеет смысл только паузу после 429, а не исчерпанную квоту или недоступный сервис
+            wait = min(cooling) if cooling else None
+            if wait is None or now + wait > deadline:
+                raise NoKeyAvailable("Нет доступных ключей API: квота исчерпана или сервис недоступен")
+            time.sleep(wait)
+
+    def for_job(self, job_id):
+        """Ключ, которым создана задача (для опроса статуса)"""
+        with self._lock:
+            name = self._pins.get(job_id)
+        if name is None and len(self.endpoints) > 1:
+            with self._connect() as conn:
+                row = conn.execute("SELECT endpoint FROM pins WHERE job_id = ?", (job_id,)).fetchone()
+            # Задачи без привязки (созданы до включения пула) опрашиваются ключом по умолчанию
+            name = row[0] if row else self.default.name
+            with self._lock:
+                self._pins[job_id] = name
+        return self.endpoints.get(name, self.default)
+
+    def pin(self, job_ids, endpoint):
+        """Запоминание ключа, которым созданы задачи"""
+        job_ids = [job_id for job_id in job_ids if job_id]
+        with self._lock:
+            for job_id in job_ids:
+                self._pins[job_id] = endpoint.name
+        if len(self.endpoints) > 1 and job_ids:
+            now = time.time()
+            with self._connect() as conn:
+                conn.executemany("INSERT OR REPLACE INTO pins (job_id, endpoint, created_at) VALUES (?, ?, ?)",
+                                 [(job_id, endpoint.name, now) for job_id in job_ids])
+                conn.execute("DELETE FROM pins WHERE created_at <= ?", (now - KEY_PINS_TTL,))
+
+    @contextmanager
+    def use(self, endpoint):
+        """Учет выполняющегося запроса через ключ"""
+        with self._lock:
+            endpoint.in_flight += 1
+            endpoint.stats["requests"] += 1
+        try:
+            yield endpoint
+        finally:
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def record_generation(self, endpoint):
+        """Учет генерации в квоте ключа; вызывается только для запросов, принятых API"""
+        with self._lock:
+            endpoint.stats["generations"] += 1
+            endpoint.used.append(time.monotonic())
+
+    def cool_down(self, endpoint, retry_after=None):
+        """Пауза для ключа после ответа 429"""
+        with self._lock:
+            endpoint.stats["throttled"] += 1
+            endpoint.cooldown_until = max(endpoint.cooldown_until, time.monotonic() + (retry_after or KEY_COOLDOWN))
+
+    def stats(self):
+        """Загрузка и состояние каждого ключа"""
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for name, endpoint in self.endpoints.items():
+                stats = dict(endpoint.stats)
+                stats.update({
+                    "base_url": endpoint.base_url,
+                    "in_flight": endpoint.in_flight,
+                    "quota_used": endpoint.quota_used(now),
+                    "quota_utilization": endpoint.quota_used(now) / KEY_QUOTA if KEY_QUOTA else 0.0,
+                    "cooldown": max(endpoint.cooldown_until - now, 0.0),
+                    "available": endpoint.is_available(now)
+                })
+                result[name] = stats
+        return result
+
+
+def endpoints_from_env(keys=SUNO_API_KEYS, base_urls=SUNO_BASE_URLS):
+    """Список ключей с адресами из SUNO_API_KEYS/SUNO_BASE_URLS (или SUNO_API_KEY/SUNO_BASE_URL)"""
+    keys = _split(keys) or [http_client.SUNO_API_KEY]
+    base_urls = _split(base_urls) or [DEFAULT_BASE_URL]
+    if len(base_urls) == 1:
+        base_urls = base_urls * len(keys)
+    elif len(keys) == 1:
+        keys = keys * len(base_urls)
+    elif len(keys) != len(base_urls):
+        raise ValueError("Число ключей в SUNO_API_KEYS и адресов в SUNO_BASE_URLS должно совпадать")
+    # Имена ключей не раскрывают сами ключи: они попадают в метрики и журнал привязок
+    return [ApiEndpoint(f"key{i + 1}", key, base_url) for i, (key, base_url) in enumerate(zip(keys, base_urls))]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Общий для процесса пул ключей"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = KeyPool(endpoints_from_env())
+    return _pool
+
+
+def _collect():
+    if _pool is None:
+        return []
+    samples = []
+    for name, stats in _pool.stats().items():
+        labels = {"key": name}
+        samples.append(("suno_key_in_flight", "Выполняющиеся запросы через ключ", "gauge", labels, stats["in_flight"]))
+        samples.append(("suno_key_requests_total", "Запросы через ключ", "counter", labels, stats["requests"]))
+        samples.append(("suno_key_generations_total", "Генерации через ключ", "counter", labels, stats["generations"]))
+        samples.append(("suno_key_throttled_total", "Ответы 429 для ключа", "counter", labels, stats["throttled"]))
+        samples.append(("suno_key_quota_utilization", "Доля израсходованной квоты ключа", "gauge", labels,
+                        stats["quota_utilization"]))
+        samples.append(("suno_key_available", "Ключ доступен для новых генераций", "gauge", labels,
+                        int(stats["available"])))
+    return samples
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,304 @@
+import glob
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+import downloads
+import metrics
+
+# Настройки дискового кэша аудио и обложек
+CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ai_composer_cache'))
+CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+# Через сколько секунд запись перепроверяется на сервере (ETag/Last-Modified)
+REVALIDATE_AFTER = float(os.getenv('MEDIA_CACHE_REVALIDATE_AFTER', '3600'))
+# Временные файлы старше стольких секунд считаются брошенными (процесс упал во время скачивания)
+TMP_MAX_AGE = float(os.getenv('MEDIA_CACHE_TMP_MAX_AGE', '3600'))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CACHE_REQUESTS = metrics.counter("media_cache_requests_total", "Обращения к дисковому кэшу по типу файла и результату")
+CACHE_EVICTIONS = metrics.counter("media_cache_evictions_total", "Вытесненные из кэша объекты")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sidecar_size INTEGER NOT NULL DEFAULT 0,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_accessed_at ON objects (accessed_at);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    checked_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash);
+"""
+
+
+def _file_hash(path):
+    """SHA-256 файла, читаемого кусками"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """Дисковый кэш файлов по хэшу содержимого с индексом по URL и LRU-вытеснением"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, revalidate_after=REVALIDATE_AFTER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidations": 0, "evictions": 0, "evicted_bytes": 0}
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "tmp"), exist_ok=True)
+        self._remove_stale_tmp()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(objects)")]
+            if "sidecar_size" not in columns:
+                # Индекс, созданный до учета производных файлов
+                conn.execute("ALTER TABLE objects ADD COLUMN sidecar_size INTEGER NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _remove_stale_tmp(self):
+        """Удаление временных файлов незавершенных скачиваний: они не учитываются в бюджете кэша"""
+        now = time.time()
+        directory = os.path.join(self.directory, "tmp")
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                # Файлы текущих скачиваний других процессов свежие: они пишутся прямо сейчас
+                if now - os.path.getmtime(path) > TMP_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _object_path(self, file_hash, ext):
+        return os.path.join(self.directory, "objects", file_hash[:2], file_hash + ext)
+
+    def _count(self, name, value=1, url=None):
+        with self._lock:
+            self._stats[name] += value
+        if url is not None:
+            CACHE_REQUESTS.inc(kind=downloads.media_kind(url), result=name)
+
+    def stats(self):
+        """Счетчики попаданий, промахов и вытеснений, а также текущий размер кэша"""
+        with self._lock:
+            stats = dict(self._stats)
+        with self._connect() as conn:
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size + sidecar_size), 0) FROM objects"
+            ).fetchone()
+        stats["objects"] = count
+        stats["bytes"] = total
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+    def fetch(self, url):
+        """Путь к локальной копии файла по URL (скачивается или перепроверяется при необходимости)"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT u.hash, o.ext, u.etag, u.last_modified, u.checked_at FROM urls u "
+                "JOIN objects o ON o.hash = u.hash WHERE u.url = ?", (url,)
+            ).fetchone()
+
+        if row is not None:
+            file_hash, ext, etag, last_modified, checked_at = row
+            path = self._object_path(file_hash, ext)
+            if os.path.exists(path):
+                if now - checked_at < self.revalidate_after:
+                    self._count("hits", url=url)
+                    self._touch(file_hash, url, now, checked=False)
+                    return path
+
+                validators = {}
+                if etag:
+                    validators["If-None-Match"] = etag
+                if last_modified:
+                    validators["If-Modified-Since"] = last_modified
+                if validators:
+                    return self._download(url, validators, cached_path=path, cached_hash=file_hash)
+
+        self._count("misses", url=url)
+        return self._download(url, {})
+
+    def lookup(self, url):
+        """Путь к уже скачанной копии файла без обращения к сети или None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT u.hash, o.ext FROM urls u JOIN objects o ON o.hash = u.hash WHERE u.url = ?",
+                               (url,)).fetchone()
+        if row is None:
+            return None
+        path = self._object_path(*row)
+        return path if os.path.exists(path) else None
+
+    def add_sidecar(self, sidecar):
+        """Учет производного файла (см. sidecar_path) в размере его объекта и вытеснение сверх бюджета"""
+        file_hash = os.path.basename(sidecar)[:64]
+        with self._connect() as conn:
+            row = conn.execute("SELECT ext FROM objects WHERE hash = ?", (file_hash,)).fetchone()
+        if row is None:
+            return
+        path = self._object_path(file_hash, row[0])
+        size = 0
+        # Размер пересчитывается по диску, поэтому повторная запись того же файла не учитывается дважды
+        for name in glob.glob(glob.escape(path) + ".*"):
+            if not name.endswith(".tmp"):
+                try:
+                    size += os.path.getsize(name)
+                except FileNotFoundError:
+                    pass
+        with self._connect() as conn:
+            conn.execute("UPDATE objects SET sidecar_size = ? WHERE hash = ?", (size, file_hash))
+        self._evict(keep=file_hash)
+
+    def _download(self, url, validators, cached_path=None, cached_hash=None):
+        ext = os.path.splitext(urlparse(url).path)[1] or ".bin"
+        tmp_path = os.path.join(self.directory, "tmp", uuid.uuid4().hex + ext)
+        try:
+            status, headers = downloads.download(url, tmp_path, headers=validators)
+        except BaseException as e:
+            # Недокачанный файл (.part) больше не нужен: следующая попытка начнется с новым именем
+            for path in (tmp_path, tmp_path + ".part"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            if not isinstance(e, requests.exceptions.RequestException):
+                raise
+            if cached_path is not None:
+                # Сервер недоступен: отдаем то, что уже есть в кэше
+                self._count("hits", url=url)
+                return cached_path
+            raise
+
+        now = time.time()
+        if status == 304:
+            self._count("revalidations", url=url)
+            self._count("hits")
+            self._touch(cached_hash, url, now, checked=True)
+            return cached_path
+
+        if cached_path is not None:
+            self._count("misses", url=url)
+
+        file_hash = _file_hash(tmp_path)
+        size = os.path.getsize(tmp_path)
+        with self._connect() as conn:
+            existing = conn.execute("SELECT ext FROM objects WHERE hash = ?", (file_hash,)).fetchone()
+        if existing is not None:
+            ext = existing[0]
+        path = self._object_path(file_hash, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # Такое содержимое уже есть в кэше (по другому URL)
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO objects (hash, ext, size, accessed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET accessed_at = excluded.accessed_at",
+                (file_hash, ext, size, now)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO urls (url, hash, etag, last_modified, checked_at) VALUES (?, ?, ?, ?, ?)",
+                (url, file_hash, headers.get("ETag"), headers.get("Last-Modified"), now)
+            )
+
+        self._evict(keep=file_hash)
+        return path
+
+    def _touch(self, file_hash, url, now, checked):
+        with self._connect() as conn:
+            conn.execute("UPDATE objects SET accessed_at = ? WHERE hash = ?", (now, file_hash))
+            if checked:
+                conn.execute("UPDATE urls SET checked_at = ? WHERE url = ?", (now, url))
+
+    def _evict(self, keep=None):
+        """Удаление давно не использованных объектов, пока кэш больше бюджета"""
+        with self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size + sidecar_size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = conn.execute(
+                "SELECT hash, ext, size + sidecar_size FROM objects ORDER BY accessed_at"
+            ).fetchall()
+            for file_hash, ext, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if file_hash == keep:
+                    continue
+                conn.execute("DELETE FROM objects WHERE hash = ?", (file_hash,))
+                conn.execute("DELETE FROM urls WHERE hash = ?", (file_hash,))
+                path = self._object_path(file_hash, ext)
+                # Вместе с файлом удаляются производные от него (см. sidecar_path)
+                for victim in [path] + glob.glob(glob.escape(path) + ".*"):
+                    try:
+                        os.remove(victim)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                self._count("evictions")
+                self._count("evicted_bytes", size)
+                CACHE_EVICTIONS.inc()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Общий для процесса экземпляр MediaCache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MediaCache()
+    return _cache
+
+
+def _collect():
+    if _cache is None:
+        return []
+    stats = _cache.stats()
+    return [
+        ("media_cache_bytes", "Текущий размер дискового кэша", "gauge", {}, stats["bytes"]),
+        ("media_cache_max_bytes", "Бюджет дискового кэша", "gauge", {}, stats["max_bytes"]),
+        ("media_cache_objects", "Число файлов в кэше", "gauge", {}, stats["objects"])
+    ]
+
+
+metrics.register_collector(_collect)
+
+
+def sidecar_path(path, suffix):
+    """Путь производного файла (результат анализа, превью), хранящегося рядом с объектом кэша"""
+    return path + suffix
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Порт для Prometheus-эндпоинта /metrics (0 - выключен)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Файл, в который периодически сохраняются метрики (пусто - выключено)
+METRICS_DUMP_FILE = os.getenv('METRICS_DUMP_FILE', '')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '15'))
+
+# Границы корзин гистограмм длительности (секунды): от коротких опросов до ожидания генерации
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+_exporters_started = False
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = ",".join('%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in key)
+    return "{" + escaped + "}"
+
+
+class Counter:
+    """Монотонно растущий счетчик с метками"""
+
+    type = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with _lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Распределение значений по корзинам (для p95/p99 в Prometheus)"""
+
+    type = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер длительности блока"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        result = []
+        with _lock:
+            for key, state in self._values.items():
+                for bound, count in zip(self.buckets, state["buckets"]):
+                    result.append((self.name + "_bucket", key + (("le", repr(float(bound))),), count))
+                result.append((self.name + "_bucket", key + (("le", "+Inf"),), state["count"]))
+                result.append((self.name + "_sum", key, state["sum"]))
+                result.append((self.name + "_count", key, state["count"]))
+        return result
+
+
+def counter(name, help_text=""):
+    """Счетчик из общего реестра (создается при первом обращении)"""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Counter(name, help_text)
+        return _metrics[name]
+
+
+def histogram(name, help_text="", buckets=DEFAULT_BUCKETS):
+    """Гистограмма из общего реестра (создается при первом обращении)"""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Histogram(name, help_text, buckets)
+        return _metrics[name]
+
+
+def rerun_timer(script):
+    """Замер полного выполнения скрипта Streamlit"""
+    return histogram("streamlit_rerun_seconds", "Время полного выполнения скрипта Streamlit").time(script=script)
+
+
+def register_collector(collector):
+    """Регистрация функции, возвращающей текущие значения в виде [(имя, описание, тип, метки, значение)]"""
+    with _lock:
+        _collectors.append(collector)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    with _lock:
+        metrics = list(_metrics.values())
+        collectors = list(_collectors)
+
+    for metric in sorted(metrics, key=lambda m: m.name):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {value}")
+
+    # Значения одной метрики от разных сборщиков выводятся одним блоком
+    collected_metrics = {}
+    for collector in collectors:
+        try:
+            collected = collector()
+        except Exception:
+            # Сбор статистики не должен ломать выдачу остальных метрик
+            continue
+        for name, help_text, metric_type, labels, value in collected:
+            entry = collected_metrics.setdefault(name, (help_text, metric_type, []))
+            entry[2].append(f"{name}{_format_labels(_label_key(labels))} {value}")
+
+    for name, (help_text, metric_type, samples) in collected_metrics.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+
+    return "\n".join(lines) + "\n"
+
+
+def dump(path=METRICS_DUMP_FILE):
+    """Сохранение метрик в файл (.json - в JSON, иначе в формате Prometheus)"""
+    text = render()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            samples = [line for line in text.splitlines() if line and not line.startswith("#")]
+            json.dump({"timestamp": time.time(), "samples": samples}, f, ensure_ascii=False, indent=2)
+        else:
+            f.write(text)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _dump_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            dump(path)
+        except OSError:
+            pass
+
+
+def start_exporters(port=METRICS_PORT, dump_file=METRICS_DUMP_FILE):
+    """Запуск эндпоинта /metrics и/или периодической записи в файл (один раз на процесс)"""
+    global _exporters_started
+    with _lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+
+    if port:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        except OSError:
+            # Порт уже занят другим процессом: метрики этого процесса доступны через файл
+            pass
+    if dump_file:
+        threading.Thread(target=_dump_loop, args=(dump_file, METRICS_DUMP_INTERVAL),
+                         name="metrics-dump", daemon=True).start()
@@ -0,0 +1,393 @@
+"""Локальная заглушка API Suno для нагрузочных тестов и работы без сети
+
+Запуск:
+    python mock_suno_server.py --port 8800 --generation-delay 5 --error-rate 0.05
+    SUNO_BASE_URL=http://127.0.0.1:8800 streamlit run app2.py
+
+Реализует POST /generate и /generate/custom-mode, опрос статуса GET /?ids[0]=...&ids[1]=...,
+а также отдает поддельные WAV-файлы и обложки (с поддержкой Range, ETag и Last-Modified).
+Если в запросе генерации есть callback_url, присылает на него уведомления, как API:
+при появлении текста (callbackType=first) и при готовности аудио (callbackType=complete).
+"""
+import argparse
+import email.utils
+import json
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+SAMPLE_RATE = 44100
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CONFIG = {
+    # Время от приема задачи до готового аудио (секунды)
+    "generation_delay": float(os.getenv('MOCK_GENERATION_DELAY', '5')),
+    # Дополнительная задержка каждого ответа API (секунды)
+    "latency": float(os.getenv('MOCK_LATENCY', '0.05')),
+    # Доля ответов 500 и 429
+    "error_rate": float(os.getenv('MOCK_ERROR_RATE', '0')),
+    "rate_limit_rate": float(os.getenv('MOCK_RATE_LIMIT_RATE', '0')),
+    "retry_after": int(os.getenv('MOCK_RETRY_AFTER', '1')),
+    # Размер отдаваемых файлов
+    "audio_seconds": float(os.getenv('MOCK_AUDIO_SECONDS', '30')),
+    "audio_bpm": float(os.getenv('MOCK_AUDIO_BPM', '120')),
+    "image_size": int(os.getenv('MOCK_IMAGE_SIZE', '512')),
+    "clips_per_request": int(os.getenv('MOCK_CLIPS_PER_REQUEST', '2')),
+    # Доля уведомлений callback_url, которые не отправляются (проверка запасного опроса)
+    "callback_drop_rate": float(os.getenv('MOCK_CALLBACK_DROP_RATE', '0'))
+}
+
+IDS_PARAM = re.compile(r"^ids\[(\d+)\]$")
+
+
+def _beat_pattern(bpm):
+    """Один такт 16-битного моно-сигнала: щелчок в начале доли и тихий тон"""
+    samples = int(SAMPLE_RATE * 60 / bpm)
+    frames = bytearray()
+    for i in range(samples):
+        tone = 0.2 * math.sin(2 * math.pi * 220 * i / SAMPLE_RATE)
+        click = 0.7 * math.exp(-i / 200) if i < 2000 else 0.0
+        frames += struct.pack("<h", int(32767 * max(-1.0, min(1.0, tone + click))))
+    return bytes(frames)
+
+
+def _wav_header(data_size):
+    return b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE" + \
+        b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16) + \
+        b"data" + struct.pack("<I", data_size)
+
+
+def _png(size):
+    """Градиентная PNG-картинка size x size"""
+    rows = bytearray()
+    for y in range(size):
+        rows.append(0)
+        for x in range(size):
+            rows += bytes((x * 255 // size, y * 255 // size, 160))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(bytes(rows), 6)) + chunk(b"IEND", b"")
+
+
+class MockState:
+    """Задачи генерации и сгенерированные файлы заглушки"""
+
+    def __init__(self, config):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.clips = {}
+        self.lock = threading.Lock()
+        self.started = email.utils.formatdate(time.time(), usegmt=True)
+        self.pattern = _beat_pattern(self.config["audio_bpm"])
+        data_size = int(self.config["audio_seconds"] * SAMPLE_RATE) * 2
+        self.audio_header = _wav_header(data_size)
+        self.audio_size = len(self.audio_header) + data_size
+        self.image = _png(self.config["image_size"])
+        self.stats = {"generate": 0, "status": 0, "status_ids": 0, "audio": 0, "image": 0, "errors": 0, "rate_limited": 0,
+                      "callbacks": 0, "callbacks_dropped": 0, "callback_errors": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def create_clips(self, payload, base_url, key=None):
+        now = time.time()
+        clips = []
+        with self.lock:
+            for _ in range(self.config["clips_per_request"]):
+                clip_id = str(uuid.uuid4())
+                clip = {
+                    "id": clip_id,
+                    "title": payload.get("title") or "Mock Track",
+                    "tags": payload.get("tags") or "",
+                    "prompt": payload.get("prompt", ""),
+                    "created_at": email.utils.formatdate(now, usegmt=True),
+                    "model_name": "chirp-v3-5",
+                    "_submitted": now,
+                    "_base_url": base_url,
+                    "_key": key,
+                    "_payload": payload
+                }
+                self.clips[clip_id] = clip
+                clips.append(clip_id)
+        return clips
+
+    def schedule_callbacks(self, clip_ids, key, url):
+        """Отправка уведомлений о задачах запроса на callback_url в моменты смены статуса"""
+        delay = self.config["generation_delay"]
+        for callback_type, at in (("first", delay * 0.3), ("complete", delay)):
+            timer = threading.Timer(at + 0.05, self._send_callback, (clip_ids, key, url, callback_type))
+            timer.daemon = True
+            timer.start()
+
+    def _send_callback(self, clip_ids, key, url, callback_type):
+        if random.random() < self.config["callback_drop_rate"]:
+            self.count("callbacks_dropped")
+            return
+        body = {"code": 200, "callbackType": callback_type,
+                "data": [self.clip_view(clip_id, key) for clip_id in clip_ids]}
+        request = urllib.request.Request(url, data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+            self.count("callbacks")
+        except OSError:
+            self.count("callback_errors")
+
+    def clip_view(self, clip_id, key=None):
+        """Состояние задачи в момент запроса; задача видна только ключу, которым создана"""
+        with self.lock:
+            clip = self.clips.get(clip_id)
+        if clip is None or clip["_key"] != key:
+            return None
+        elapsed = time.time() - clip["_submitted"]
+        delay = self.config["generation_delay"]
+        view = {key: value for key, value in clip.items() if not key.startswith("_")}
+        base_url = clip["_base_url"]
+        if elapsed < delay * 0.3:
+            view["status"] = "queued"
+        elif elapsed < delay:
+            view["status"] = "streaming"
+            view["lyric"] = f"[Verse]\n{clip['prompt']}"
+            view["image_url"] = f"{base_url}/media/{clip_id}.png"
+        else:
+            view["status"] = "complete"
+            view["lyric"] = f"[Verse]\n{clip['prompt']}"
+            view["image_url"] = f"{base_url}/media/{clip_id}.png"
+            view["audio_url"] = f"{base_url}/media/{clip_id}.wav"
+            view["duration"] = self.config["audio_seconds"]
+        return view
+
+    def audio_bytes(self, start, end):
+        """Байты WAV-файла в диапазоне [start, end) кусками"""
+        header = self.audio_header
+        pattern = self.pattern
+        position = start
+        while position < end:
+            if position < len(header):
+                piece = header[position:min(end, len(header))]
+            else:
+                offset = (position - len(header)) % len(pattern)
+                length = min(end - position, len(pattern) - offset, CHUNK_SIZE)
+                piece = pattern[offset:offset + length]
+            yield piece
+            position += len(piece)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockSuno/1.0"
+    # Без этого заголовки и тело уходят разными пакетами и keep-alive ждет задержанный ACK (~40 мс)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _base_url(self):
+        host = self.headers.get("Host") or "%s:%s" % self.server.server_address[:2]
+        return f"http://{host}"
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _inject_faults(self):
+        """Имитация задержки, ошибок сервера и ограничения частоты; True - ответ уже отправлен"""
+        config = self.state.config
+        if config["latency"]:
+            time.sleep(config["latency"])
+        if random.random() < config["rate_limit_rate"]:
+            self.state.count("rate_limited")
+            self._send_json(429, {"error": "Too Many Requests"}, {"Retry-After": str(config["retry_after"])})
+            return True
+        if random.random() < config["error_rate"]:
+            self.state.count("errors")
+            self._send_json(500, {"error": "Internal Server Error"})
+            return True
+        return False
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+
+        if path not in ("/generate", "/generate/custom-mode"):
+            self._send_json(404, {"error": "Not Found"})
+            return
+        if self._inject_faults():
+            return
+
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "Invalid JSON"})
+            return
+
+        self.state.count("generate")
+        key = self.headers.get("Authorization")
+        clip_ids = self.state.create_clips(payload, self._base_url(), key)
+        if payload.get("callback_url"):
+            self.state.schedule_callbacks(clip_ids, key, payload["callback_url"])
+        if payload.get("wait_audio"):
+            time.sleep(self.state.config["generation_delay"])
+        self._send_json(200, [self.state.clip_view(clip_id, key) for clip_id in clip_ids])
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith("/media/"):
+            self._send_media(parsed.path[len("/media/"):])
+            return
+        if parsed.path != "/":
+            self._send_json(404, {"error": "Not Found"})
+            return
+        if self._inject_faults():
+            return
+
+        ids = []
+        for name, value in parse_qsl(parsed.query):
+            match = IDS_PARAM.match(name)
+            if match:
+                ids.append((int(match.group(1)), value))
+        ids = [value for _, value in sorted(ids)]
+        self.state.count("status")
+        self.state.count("status_ids", len(ids))
+        key = self.headers.get("Authorization")
+        clips = [view for view in (self.state.clip_view(clip_id, key) for clip_id in ids) if view is not None]
+        self._send_json(200, clips)
+
+    def _send_media(self, name):
+        clip_id, ext = os.path.splitext(name)
+        if ext not in (".wav", ".png"):
+            self._send_json(404, {"error": "Not Found"})
+            return
+
+        etag = f'"{ext[1:]}-{self.state.audio_size if ext == ".wav" else len(self.state.image)}"'
+        if self.headers.get("If-None-Match") == etag or \
+                (self.headers.get("If-Modified-Since") == self.state.started and not self.headers.get("If-None-Match")):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if ext == ".png":
+            self.state.count("image")
+            size = len(self.state.image)
+            content_type = "image/png"
+        else:
+            self.state.count("audio")
+            size = self.state.audio_size
+            content_type = "audio/wav"
+
+        start, end, status = 0, size, 200
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            end = min(end, size)
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.state.started)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.end_headers()
+
+        if ext == ".png":
+            self.wfile.write(self.state.image[start:end])
+        else:
+            for piece in self.state.audio_bytes(start, end):
+                self.wfile.write(piece)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=None, verbose=False):
+        super().__init__(address, MockHandler)
+        self.state = MockState(config or {})
+        self.verbose = verbose
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_server(host="127.0.0.1", port=0, **config):
+    """Запуск заглушки в фоновом потоке; возвращает сервер (адрес в server.base_url)"""
+    server = MockServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever, name="mock-suno", daemon=True)
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальная заглушка API Suno")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--generation-delay", type=float, default=DEFAULT_CONFIG["generation_delay"],
+                        help="Секунд от приема задачи до готового аудио")
+    parser.add_argument("--latency", type=float, default=DEFAULT_CONFIG["latency"],
+                        help="Задержка каждого ответа API в секундах")
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_CONFIG["error_rate"],
+                        help="Доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=DEFAULT_CONFIG["rate_limit_rate"],
+                        help="Доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=DEFAULT_CONFIG["retry_after"],
+                        help="Значение Retry-After для ответов 429")
+    parser.add_argument("--audio-seconds", type=float, default=DEFAULT_CONFIG["audio_seconds"],
+                        help="Длительность отдаваемого WAV (определяет размер файла)")
+    parser.add_argument("--audio-bpm", type=float, default=DEFAULT_CONFIG["audio_bpm"])
+    parser.add_argument("--image-size", type=int, default=DEFAULT_CONFIG["image_size"],
+                        help="Сторона обложки в пикселях")
+    parser.add_argument("--clips-per-request", type=int, default=DEFAULT_CONFIG["clips_per_request"])
+    parser.add_argument("--callback-drop-rate", type=float, default=DEFAULT_CONFIG["callback_drop_rate"],
+                        help="Доля неотправляемых уведомлений callback_url")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    config = {key: value for key, value in vars(args).items() if key in DEFAULT_CONFIG}
+    server = MockServer((args.host, args.port), config, verbose=args.verbose)
+    print(f"Заглушка API Suno: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
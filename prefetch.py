@@ -0,0 +1,51 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import media_cache
+
+# Фоновая предзагрузка аудио видимых треков (выключена по умолчанию)
+PREFETCH_ENABLED = os.getenv('PREFETCH_AUDIO', '0') == '1'
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '2'))
+
+_executor = None
+_in_flight = set()
+# URL, уже загруженные в кэш этим процессом: при повторных перезапусках скрипта не трогаем диск
+_done = set()
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        return _executor
+
+
+def _fetch(url):
+    try:
+        media_cache.get_cache().fetch(url)
+        with _lock:
+            _done.add(url)
+    except Exception:
+        # Предзагрузка необязательна: ошибка повторится при явном скачивании
+        pass
+    finally:
+        with _lock:
+            _in_flight.discard(url)
+
+
+def prefetch(urls):
+    """Постановка URL в фоновую загрузку в кэш (без ожидания результата)"""
+    if not PREFETCH_ENABLED:
+        return
+    executor = _get_executor()
+    for url in urls:
+        if not url:
+            continue
+        with _lock:
+            if url in _in_flight or url in _done:
+                continue
+            _in_flight.add(url)
+        executor.submit(_fetch, url)
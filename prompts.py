@@ -0,0 +1,16 @@
+def generate_prompt(base_prompt, genre, mood, voice_gender, additional_params):
+    """Генерация полного промпта на основе параметров"""
+    prompt_parts = [base_prompt]
+
+    if genre:
+        prompt_parts.append(f"Genre: {genre}")
+    if mood:
+        prompt_parts.append(f"Mood: {mood}")
+    if voice_gender:
+        prompt_parts.append(f"Voice: {voice_gender}")
+
+    for param, value in additional_params.items():
+        if value:
+            prompt_parts.append(f"{param}: {value}")
+
+    return ". ".join(prompt_parts)
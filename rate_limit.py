@@ -0,0 +1,197 @@
+import email.utils
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+
+import metrics
+
+# Начальная и предельная частота запросов (в секунду) и размер «пачки» токенов
+RATE_LIMIT_RPS = float(os.getenv('RATE_LIMIT_RPS', '5'))
+RATE_LIMIT_MAX_RPS = float(os.getenv('RATE_LIMIT_MAX_RPS', '50'))
+RATE_LIMIT_MIN_RPS = float(os.getenv('RATE_LIMIT_MIN_RPS', '0.2'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '10'))
+# Границы числа одновременных запросов (подбирается по AIMD)
+CONCURRENCY_INITIAL = float(os.getenv('RATE_LIMIT_CONCURRENCY', '4'))
+CONCURRENCY_MIN = float(os.getenv('RATE_LIMIT_MIN_CONCURRENCY', '1'))
+CONCURRENCY_MAX = float(os.getenv('RATE_LIMIT_MAX_CONCURRENCY', '32'))
+# Сколько запрос может ждать своей очереди и сколько раз повторяется после 429
+QUEUE_TIMEOUT = float(os.getenv('RATE_LIMIT_QUEUE_TIMEOUT', '300'))
+MAX_THROTTLE_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '5'))
+DEFAULT_RETRY_AFTER = float(os.getenv('RATE_LIMIT_DEFAULT_RETRY_AFTER', '2'))
+
+DEFAULT_USER = "default"
+
+
+class QueueTimeout(requests.exceptions.RequestException):
+    """Запрос не дождался своей очереди (обрабатывается интерфейсом как ошибка запроса к API)"""
+
+
+class AdaptiveLimiter:
+    """Ограничение частоты (token bucket) и параллельности (AIMD) со справедливой очередью по пользователям
+
+    Успешные ответы плавно повышают лимиты, ответы 429 и таймауты сокращают их вдвое.
+    Очередь обслуживает пользователей по кругу, поэтому один активный пользователь
+    или пакетная задача не вытесняют остальных.
+    """
+
+    def __init__(self, name, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST, concurrency=CONCURRENCY_INITIAL):
+        self.name = name
+        self._cond = threading.Condition()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._limit = concurrency
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._queues = {}
+        self._order = deque()
+        self._stats = {"granted": 0, "throttled": 0, "timeouts": 0}
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+
+    def _wait_time(self, now):
+        """Через сколько секунд может освободиться место для следующего запроса"""
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self._rate
+        # Ждем завершения одного из выполняющихся запросов
+        return 1.0
+
+    def acquire(self, user=DEFAULT_USER, timeout=QUEUE_TIMEOUT):
+        """Ожидание своей очереди; после выполнения запроса обязательно вызвать release"""
+        user = user or DEFAULT_USER
+        ticket = object()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._order.append(user)
+            self._queues[user].append(ticket)
+
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                head_user = self._order[0]
+                is_next = self._queues[head_user][0] is ticket
+                if is_next and now >= self._blocked_until and self._tokens >= 1 and self._in_flight < int(self._limit):
+                    self._queues[head_user].popleft()
+                    self._order.popleft()
+                    if self._queues[head_user]:
+                        # У пользователя есть еще запросы: он встает в конец круга
+                        self._order.append(head_user)
+                    else:
+                        del self._queues[head_user]
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self._stats["granted"] += 1
+                    self._cond.notify_all()
+                    return
+
+                if now >= deadline:
+                    self._remove(user, ticket)
+                    self._stats["timeouts"] += 1
+                    self._cond.notify_all()
+                    raise QueueTimeout(f"Превышено время ожидания очереди запросов к API ({self.name})")
+                self._cond.wait(min(self._wait_time(now), deadline - now))
+
+    def _remove(self, user, ticket):
+        queue = self._queues[user]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[user]
+            self._order.remove(user)
+
+    def release(self, throttled=False, retry_after=None):
+        """Завершение запроса и подстройка лимитов по его результату"""
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                # Мультипликативное уменьшение
+                self._stats["throttled"] += 1
+                self._limit = max(CONCURRENCY_MIN, self._limit / 2)
+                self._rate = max(RATE_LIMIT_MIN_RPS, self._rate / 2)
+                self._tokens = min(self._tokens, 0)
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            else:
+                # Аддитивное увеличение: примерно +1 к параллельности за «окно» успешных запросов
+                self._limit = min(CONCURRENCY_MAX, self._limit + 1 / max(self._limit, 1))
+                self._rate = min(RATE_LIMIT_MAX_RPS, self._rate + 1 / max(self._rate, 1))
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user=DEFAULT_USER):
+        """Контекст для одного запроса; внутри можно сообщить о 429 через outcome"""
+        self.acquire(user)
+        outcome = {"throttled": False, "retry_after": None}
+        try:
+            yield outcome
+        finally:
+            self.release(outcome["throttled"], outcome["retry_after"])
+
+    def stats(self):
+        """Текущие частота, лимит параллельности и глубина очереди"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "rate": self._rate,
+                "concurrency_limit": self._limit,
+                "in_flight": self._in_flight,
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "queued_users": len(self._queues),
+                "blocked_for": max(self._blocked_until - time.monotonic(), 0.0)
+            })
+        return stats
+
+
+def parse_retry_after(value):
+    """Значение заголовка Retry-After в секундах (число секунд или HTTP-дата)"""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Общий для процесса ограничитель для группы эндпоинтов"""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name)
+        return _limiters[name]
+
+
+def _collect():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    samples = []
+    for name, limiter in limiters.items():
+        stats = limiter.stats()
+        labels = {"limiter": name}
+        samples.append(("rate_limit_rate", "Текущая разрешенная частота запросов в секунду", "gauge", labels, stats["rate"]))
+        samples.append(("rate_limit_concurrency", "Текущий лимит одновременных запросов", "gauge", labels,
+                        stats["concurrency_limit"]))
+        samples.append(("rate_limit_in_flight", "Выполняющиеся запросы", "gauge", labels, stats["in_flight"]))
+        samples.append(("rate_limit_queue_depth", "Запросы, ожидающие в очереди", "gauge", labels, stats["queue_depth"]))
+        samples.append(("rate_limit_throttled_total", "Ответы 429 и таймауты", "counter", labels, stats["throttled"]))
+    return samples
+
+
+metrics.register_collector(_collect)
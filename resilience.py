@@ -0,0 +1,228 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+import metrics
+
+# Повторы идемпотентных запросов (опрос статуса, скачивание): число попыток и задержки (секунды)
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '8'))
+# Предохранитель: после скольких сбоев подряд запросы отклоняются сразу и на сколько секунд
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+# Дублирующий запрос отправляется, если ответа нет дольше порога (0 - выключено)
+HEDGE_STATUS_AFTER = float(os.getenv('HEDGE_STATUS_AFTER', '0'))
+HEDGE_DOWNLOAD_AFTER = float(os.getenv('HEDGE_DOWNLOAD_AFTER', '0'))
+HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', '8'))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+RETRIES = metrics.counter("resilience_retries_total", "Повторные попытки запросов после сбоя")
+HEDGES = metrics.counter("resilience_hedged_requests_total", "Дублирующие запросы и какой из ответов пришел первым")
+REJECTED = metrics.counter("resilience_breaker_rejected_total", "Запросы, отклоненные открытым предохранителем")
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Сервис недоступен: предохранитель открыт, запрос не отправлялся"""
+
+
+def is_transient(error):
+    """Сбой, после которого имеет смысл повторить запрос: обрыв, таймаут или ответ 5xx"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии сбоев запросы сразу отклоняются, затем пропускается один пробный"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self._failure_threshold = max(failure_threshold, 1)
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {"failures": 0, "rejected": 0, "opened": 0}
+
+    def before(self):
+        """Проверка перед запросом; при открытом предохранителе - CircuitOpenError
+
+        Возвращает True, если запрос пропущен как пробный.
+        """
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == CLOSED:
+                return False
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._stats["rejected"] += 1
+            retry_in = max(self._reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+        REJECTED.inc(breaker=self.name)
+        raise CircuitOpenError(f"Сервис временно недоступен ({self.name}), повторите через {retry_in:.0f} с")
+
+    def cancel_probe(self):
+        """Отказ от пробного запроса, который так и не был отправлен: пробу сможет сделать следующий"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+
+    def success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def failure(self):
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self._failure_threshold:
+                if self._state != OPEN:
+                    self._stats["opened"] += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def call(self, fn, *args, **kwargs):
+        """Вызов через предохранитель; сбоем считаются только обрывы, таймауты и 5xx"""
+        self.before()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_transient(e):
+                self.failure()
+            else:
+                self.success()
+            raise
+        self.success()
+        return result
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["state"] = self.state
+        return stats
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, maximum=RETRY_MAX_DELAY):
+    """Экспоненциальная задержка со случайным разбросом (full jitter)"""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def retry(fn, operation, attempts=RETRY_ATTEMPTS, should_retry=is_transient):
+    """Вызов идемпотентной операции с повторами при временных сбоях"""
+    for attempt in range(attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts or not should_retry(e):
+                raise
+            RETRIES.inc(operation=operation)
+            time.sleep(backoff_delay(attempt))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _executor
+
+
+def hedged(fn, delay, operation, discard=None):
+    """Вызов fn с дублированием: если ответа нет через delay секунд, отправляется второй такой же запрос
+
+    Возвращается первый успешный результат; опоздавший успешный результат передается в discard
+    (например, чтобы закрыть соединение). При delay <= 0 fn вызывается напрямую.
+    """
+    if delay <= 0:
+        return fn()
+
+    executor = _get_executor()
+    futures = [executor.submit(fn)]
+    done, _ = wait(futures, timeout=delay)
+    if not done:
+        HEDGES.inc(operation=operation, result="sent")
+        futures.append(executor.submit(fn))
+
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            if len(futures) > 1:
+                HEDGES.inc(operation=operation, result="primary" if future is futures[0] else "hedge")
+            for other in pending:
+                other.add_done_callback(lambda f: _discard(f, discard))
+            return future.result()
+    raise error
+
+
+def _discard(future, discard):
+    if discard is not None and not future.cancelled() and future.exception() is None:
+        discard(future.result())
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Общий для процесса предохранитель для сервиса"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def _collect():
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    samples = []
+    for name, breaker in breakers.items():
+        stats = breaker.stats()
+        labels = {"breaker": name}
+        samples.append(("resilience_breaker_state", "Состояние предохранителя (0 - закрыт, 1 - пробный, 2 - открыт)",
+                        "gauge", labels, STATE_VALUES[stats["state"]]))
+        samples.append(("resilience_breaker_failures_total", "Сбои, учтенные предохранителем", "counter", labels,
+                        stats["failures"]))
+        samples.append(("resilience_breaker_opened_total", "Сколько раз предохранитель открывался", "counter", labels,
+                        stats["opened"]))
+    return samples
+
+
+metrics.register_collector(_collect)
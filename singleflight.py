@@ -0,0 +1,90 @@
+import copy
+import threading
+
+import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Объединение одновременных одинаковых вызовов в один вызов к API"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "executed": 0, "deduplicated": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Вызов fn или ожидание уже выполняющегося вызова с тем же ключом"""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._stats["executed"] += 1
+            else:
+                self._stats["deduplicated"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Каждый ожидающий получает свою копию, чтобы изменения в одной сессии не влияли на другие
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Счетчики вызовов, выполненных запросов и объединенных дубликатов"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def group(name):
+    """Общий для процесса именованный экземпляр SingleFlight"""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight()
+        return _groups[name]
+
+
+def stats():
+    """Статистика всех именованных групп"""
+    with _groups_lock:
+        groups = dict(_groups)
+    return {name: flight.stats() for name, flight in groups.items()}
+
+
+def _collect():
+    samples = []
+    for name, group_stats in stats().items():
+        samples.append(("singleflight_calls_total", "Вызовы через single-flight", "counter",
+                        {"group": name}, group_stats["calls"]))
+        samples.append(("singleflight_deduplicated_total", "Вызовы, присоединенные к уже выполняющемуся", "counter",
+                        {"group": name}, group_stats["deduplicated"]))
+    return samples
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,208 @@
+import sqlite3
+import time
+
+import requests
+
+import callback_server
+import http_client
+import idempotency
+import key_pool
+import metrics
+import rate_limit
+import resilience
+import singleflight
+import track_library
+
+# Адрес API можно переопределить, например для локальной заглушки mock_suno_server.py;
+# несколько ключей и адресов задаются в SUNO_API_KEYS/SUNO_BASE_URLS (см. key_pool.py)
+BASE_URL = key_pool.DEFAULT_BASE_URL
+
+API_SECONDS = metrics.histogram("suno_api_request_seconds", "Длительность запросов к API Suno")
+API_REQUESTS = metrics.counter("suno_api_requests_total", "Запросы к API Suno по эндпоинту и коду ответа")
+API_BYTES = metrics.counter("suno_api_response_bytes_total", "Объем ответов API Suno")
+GENERATION_CACHE = metrics.counter("generation_cache_total", "Обращения к кэшу результатов генерации")
+
+
+def submit_generation(prompt, make_instrumental=False, wait_audio=True, tags=None, title=None, custom_mode=False,
+                      fresh=False, user=None):
+    """Отправка запроса на генерацию (без вывода в интерфейс)
+
+    Повторный одинаковый запрос возвращает сохраненный результат, если не указан fresh=True.
+    user - идентификатор сессии для справедливой очереди ограничителя частоты.
+    """
+    payload = {
+        "prompt": prompt,
+        "make_instrumental": make_instrumental,
+        "wait_audio": wait_audio
+    }
+
+    if tags:
+        payload["tags"] = tags
+    if title:
+        payload["title"] = title
+    if not wait_audio:
+        # В режиме уведомлений API само сообщит о готовности задачи (см. callback_server.py)
+        url = callback_server.callback_url()
+        if url:
+            payload["callback_url"] = url
+
+    path = "/generate/custom-mode" if custom_mode else "/generate"
+
+    key = idempotency.request_key(path, prompt, make_instrumental, wait_audio, tags, title)
+    # Одинаковые запросы из разных сессий, пришедшие во время генерации, ждут один общий вызов
+    endpoint = "custom-mode" if custom_mode else "generate"
+    return singleflight.group("generate").do((key, fresh), _generate, endpoint, path, payload, key, fresh, user)
+
+
+def _generate(endpoint, path, payload, key, fresh, user):
+    store = idempotency.get_store()
+    if not fresh:
+        cached = store.get(key)
+        if cached is not None and _has_failed(cached):
+            # Опрос статуса сообщил об ошибке задачи: такой результат больше не отдается
+            store.delete(key)
+            cached = None
+        GENERATION_CACHE.inc(result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+
+    result = _request(endpoint, "POST", path, user=user, json=payload,
+                      timeout=http_client.generate_timeout(payload["wait_audio"]))
+    if not _has_failed(result):
+        store.put(key, result)
+    _record(result, prompt=payload["prompt"], tags=payload.get("tags"))
+    return result
+
+
+def _is_failed(track):
+    return track.get("status") == "error" or bool(track.get("error_message"))
+
+
+def _has_failed(result):
+    """Нет треков или хотя бы один завершился ошибкой (по ответу или по последнему статусу в библиотеке)"""
+    tracks = extract_tracks(result)
+    if not tracks or any(_is_failed(track) for track in tracks):
+        return True
+    try:
+        library = track_library.get_library()
+        return any(_is_failed(library.get(track["id"]) or {}) for track in tracks if track.get("id"))
+    except sqlite3.Error:
+        return False
+
+
+def fetch_details(ids, user=None):
+    """Получение деталей генерации по списку ID"""
+    if isinstance(ids, str):
+        ids = [ids]
+
+    return singleflight.group("status").do(tuple(ids), _fetch_details, ids, user)
+
+
+def _fetch_details(ids, user):
+    # Статус задачи запрашивается тем ключом, которым она создана
+    pool = key_pool.get_pool()
+    groups = {}
+    for music_id in ids:
+        groups.setdefault(pool.for_job(music_id).name, []).append(music_id)
+
+    results = [_fetch_group(group_ids, user) for group_ids in groups.values()]
+    result = results[0] if len(results) == 1 else [track for result in results for track in extract_tracks(result)]
+    _record(result)
+    return result
+
+
+def _record(result, prompt=None, tags=None):
+    """Сохранение треков в библиотеку; ошибка записи не должна мешать генерации"""
+    try:
+        track_library.get_library().record(extract_tracks(result), prompt=prompt, tags=tags)
+    except sqlite3.Error:
+        pass
+
+
+def _fetch_group(ids, user):
+    query = "&".join(f"ids[{i}]={music_id}" for i, music_id in enumerate(ids))
+    path = f"/?{query}"
+
+    # Опрос статуса идемпотентен: при сбое повторяется, а при медленном ответе может дублироваться
+    def request():
+        return _request("status", "GET", path, user=user, job_id=ids[0])
+
+    return resilience.retry(lambda: resilience.hedged(request, resilience.HEDGE_STATUS_AFTER, "status"), "status")
+
+
+def _request(endpoint, method, path, user=None, job_id=None, timeout=http_client.DEFAULT_TIMEOUT, **kwargs):
+    """Запрос к API через пул ключей, предохранитель и ограничитель частоты
+
+    Новая генерация уходит на наименее загруженный доступный ключ, запрос статуса - на ключ,
+    создавший задачу job_id. После 429 ключ встает на паузу, а генерация повторяется через другой ключ.
+    Когда API недоступен, предохранитель сразу выбрасывает resilience.CircuitOpenError
+    (наследник ConnectionError), не занимая потоки ожиданием таймаута.
+    """
+    pool = key_pool.get_pool()
+    is_generation = endpoint != "status"
+    for attempt in range(rate_limit.MAX_THROTTLE_RETRIES + 1):
+        api = pool.choose() if is_generation else pool.for_job(job_id)
+        kind = "generate" if is_generation else "status"
+        limiter = rate_limit.get_limiter(f"{kind}/{api.name}")
+        breaker = api.breakers[kind]
+        # Проверка до места в очереди: отклоненный запрос не занимает место ограничителя
+        # и не считается для него успешным, из-за чего частота запросов росла бы
+        probe = breaker.before()
+        sent = False
+        try:
+            with pool.use(api), limiter.slot(user) as outcome:
+                sent = True
+                try:
+                    response = _send(endpoint, api, method, path, timeout, **kwargs)
+                except Exception as e:
+                    # Любой исход отправленного запроса (в том числе не сетевая ошибка) возвращает предохранитель в норму
+                    if resilience.is_transient(e):
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    outcome["throttled"] = isinstance(e, requests.exceptions.Timeout)
+                    raise
+                if response.status_code >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                if response.status_code == 429 and attempt < rate_limit.MAX_THROTTLE_RETRIES:
+                    outcome["throttled"] = True
+                    outcome["retry_after"] = rate_limit.parse_retry_after(response.headers.get("Retry-After"))
+                    pool.cool_down(api, outcome["retry_after"])
+                    continue
+        finally:
+            # Запрос не ушел (истекло ожидание места в очереди): пробу сделает следующий запрос
+            if probe and not sent:
+                breaker.cancel_probe()
+        response.raise_for_status()
+        result = response.json()
+        if is_generation:
+            # В квоту ключа идут только генерации, принятые API, а не отклоненные или 429
+            pool.record_generation(api)
+            pool.pin([track.get("id") for track in extract_tracks(result)], api)
+        return result
+
+
+def _send(endpoint, api, method, path, timeout, **kwargs):
+    """Один HTTP-запрос с замером времени, кода ответа и объема"""
+    status = "error"
+    start = time.perf_counter()
+    try:
+        response = http_client.get_session().request(method, api.base_url + path, headers=api.headers,
+                                                     timeout=timeout, **kwargs)
+        status = str(response.status_code)
+        API_BYTES.inc(len(response.content), endpoint=endpoint)
+        return response
+    finally:
+        API_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, status=status)
+        API_REQUESTS.inc(endpoint=endpoint, status=status, key=api.name)
+
+
+def extract_tracks(result):
+    """Приведение ответа API к списку треков"""
+    if isinstance(result, list):
+        return result
+    if isinstance(result, dict):
+        return [result]
+    return []
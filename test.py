@@ -1,8 +1,17 @@
 import streamlit as st
 import requests
 import os
+import uuid
 from dotenv import load_dotenv
-from io import BytesIO
+
+import audio_analysis
+import job_poller
+import metrics
+import prefetch
+import suno_api
+import thumbnails
+import transcode
+import zip_export
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -10,16 +19,15 @@ load_dotenv()
 # Получение API ключа из переменных окружения
 SUNO_API_KEY = os.getenv('SUNO_API_KEY')
 
-BASE_URL = "https://api.aimlapi.com"
+BASE_URL = suno_api.BASE_URL
+
+# Интервал автообновления статуса фоновых задач (секунды)
+UI_REFRESH_SECONDS = float(os.getenv('UI_REFRESH_SECONDS', '2'))
+# Сколько карточек треков выводится на одной странице списка
+TRACKS_PER_PAGE = int(os.getenv('TRACKS_PER_PAGE', '10'))
 
-def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True):
+def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True, fresh=False):
     """Генерация музыки и текста с использованием API Suno v3.5"""
-    url = f"{BASE_URL}/generate"
-    headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
         "prompt": prompt,
         "make_instrumental": make_instrumental,
@@ -31,11 +39,10 @@ def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True):
 
     try:
         with st.spinner("Генерация музыки и текста..."):
-            response = requests.post(url, json=payload, headers=headers)
+            result = suno_api.submit_generation(prompt, make_instrumental, wait_audio, fresh=fresh,
+                                                  user=st.session_state.setdefault('user_id', str(uuid.uuid4())))
         
-        response.raise_for_status()
         st.success("Запрос на генерацию музыки и текста успешно выполнен!")
-        result = response.json()
         with st.expander("Просмотреть ответ API"):
             st.json(result)
         return result
@@ -44,11 +51,19 @@ def generate_music_and_text(prompt, make_instrumental=False, wait_audio=True):
     
     return None
 
-@st.cache_data
-def download_audio(url):
-    """Скачивание аудио файла с кэшированием"""
-    response = requests.get(url)
-    return BytesIO(response.content)
+def display_analysis(analysis, track):
+    """Осциллограмма и параметры трека из сохраненного анализа, без повторного чтения аудио"""
+    st.area_chart(analysis['peaks'], height=80)
+    minutes, seconds = divmod(int(round(analysis['duration'])), 60)
+    parts = [f"Длительность: {minutes}:{seconds:02d}"]
+    if analysis.get('bpm'):
+        parts.append(f"темп ≈ {analysis['bpm']:.0f} BPM")
+    if analysis.get('loudness_lufs') is not None:
+        parts.append(f"громкость {analysis['loudness_lufs']:.1f} LUFS")
+    parts.append(f"RMS {analysis['rms_dbfs']:.1f} dBFS")
+    st.caption(", ".join(parts))
+    for problem in audio_analysis.mismatches(analysis, track):
+        st.warning(f"Не совпадает с запросом: {problem}")
 
 def display_track_info(track, index):
     """Отображение информации о треке"""
@@ -59,7 +74,7 @@ def display_track_info(track, index):
     with col1:
         image_url = track.get('image_url')
         if image_url:
-            st.image(image_url, caption="Обложка трека", use_column_width=True)
+            st.image(thumbnails.local_image(image_url, thumbnails.CARD_WIDTH), caption="Обложка трека", width="stretch")
     
     with col2:
         st.write(f"ID: {track.get('id', 'Не указан')}")
@@ -74,16 +89,20 @@ def display_track_info(track, index):
         
         audio_url = track.get('audio_url')
         if audio_url:
-            st.audio(audio_url, format='audio/wav')
+            # Играется облегченная версия; пока она готовится в фоне - отрывок или исходный URL
+            source, mime, kind = transcode.playback_source(audio_url)
+            st.audio(source, format=mime)
+            if kind == 'clip':
+                st.caption(f"Отрывок: первые {transcode.CLIP_SECONDS:.0f} секунд, полная облегченная версия готовится")
+            analysis = audio_analysis.for_url(audio_url)
+            if analysis:
+                display_analysis(analysis, track)
             
             audio_filename = f"generated_track_{index+1}.wav"
-            audio_file = download_audio(audio_url)
-            st.download_button(
-                label="Скачать трек",
-                data=audio_file,
-                file_name=audio_filename,
-                mime="audio/wav"
-            )
+            # Файл скачивается в кэш только по нажатию и отдается браузеру потоково, минуя память Streamlit
+            st.link_button("Скачать трек", zip_export.track_download_url(audio_url, audio_filename, st.context.url))
+        elif track.get('status') and track['status'] not in job_poller.FINAL_STATUSES:
+            st.info("Аудио еще генерируется...")
         else:
             st.warning("URL аудио не найден для этого трека.")
         
@@ -92,6 +111,74 @@ def display_track_info(track, index):
     
     st.markdown("---")  # Разделитель между треками
 
+@st.fragment
+def display_track_card(track, index):
+    """Карточка трека; действия внутри нее перезапускают только этот фрагмент"""
+    display_track_info(track, index)
+
+def build_export(tracks, key, total=None):
+    """Сборка ZIP-архива с индикатором прогресса; путь к архиву сохраняется в session_state[key]"""
+    bar = st.progress(0.0, text="Сборка архива...")
+
+    def progress(done):
+        text = f"Сборка архива: {done} из {total}" if total else f"Сборка архива: {done}"
+        bar.progress(min(done / total, 1.0) if total else 0.0, text=text)
+
+    st.session_state[key] = zip_export.export_zip(tracks, progress)
+    bar.empty()
+
+def display_export_download(key):
+    """Ссылка на собранный архив: файл отдается с диска потоково сервером архивов, минуя память Streamlit"""
+    path = st.session_state.get(key)
+    if path and os.path.exists(path):
+        st.link_button("Скачать ZIP", zip_export.download_url(path, st.context.url), key=f"{key}_download")
+
+def display_export(tracks):
+    """Скачивание всех или выбранных треков одним архивом с текстами, обложками и манифестом"""
+    with st.expander("Скачать все или выбранные треки (ZIP)"):
+        selected = st.multiselect(
+            "Треки (если ничего не выбрано - все)",
+            list(range(len(tracks))),
+            format_func=lambda i: f"{i+1}. {tracks[i].get('title') or 'Без названия'}",
+            key="export_selection"
+        )
+        chosen = [tracks[i] for i in selected] or tracks
+        if st.button(f"Собрать архив ({len(chosen)})", key="export_build"):
+            build_export(chosen, 'export_path', len(chosen))
+        display_export_download('export_path')
+
+def display_track_list(tracks):
+    """Постраничный вывод треков: на каждом перезапуске отрисовывается только текущая страница"""
+    pages = (len(tracks) + TRACKS_PER_PAGE - 1) // TRACKS_PER_PAGE
+    page = 1
+    if pages > 1:
+        page = st.number_input("Страница", min_value=1, max_value=pages, value=1, key="tracks_page")
+    first = (page - 1) * TRACKS_PER_PAGE
+    visible = tracks[first:first + TRACKS_PER_PAGE]
+
+    display_export(tracks)
+
+    prefetch.prefetch(track.get('audio_url') for track in visible)
+    for i, track in enumerate(visible):
+        display_track_card(track, first + i)
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def display_pending_jobs():
+    """Автообновляемые карточки фоновых задач: название и текст, затем обложка и аудио появляются по мере готовности"""
+    tracks, pending = job_poller.refresh_tracks(st.session_state['tracks'])
+    st.session_state['tracks'] = tracks
+
+    if pending:
+        ready = sum(1 for track in tracks if track.get('audio_url'))
+        st.info(f"Музыка генерируется в фоновом режиме: готово треков {ready} из {len(tracks)}. "
+                "Треки появляются на странице по мере готовности.")
+        for i, track in enumerate(tracks):
+            display_track_info(track, i)
+    else:
+        # Все задачи завершены: перерисовываем страницу целиком
+        st.session_state['tracks_pending'] = False
+        st.rerun()
+
 def generate_prompt(base_prompt, genre, mood, voice_gender, additional_params):
     """Генерация полного промпта на основе параметров"""
     prompt_parts = [base_prompt.strip()]
@@ -141,7 +228,8 @@ def main():
             key = st.selectbox("Тональность", ["", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"])
     
     make_instrumental = st.checkbox("Сделать инструментальной", value=False)
-    wait_audio = st.checkbox("Ждать генерации аудио", value=True)
+    wait_audio = st.checkbox("Ждать генерации аудио", value=False)
+    fresh = st.checkbox("Новый вариант (не брать готовый результат для такого же запроса)", value=False)
     
     additional_params = {
         "Instruments": instruments,
@@ -161,24 +249,31 @@ def main():
             st.error("Базовое описание не может быть пустым. Пожалуйста, введите описание желаемой музыки.")
             return
         
-        result = generate_music_and_text(full_prompt, make_instrumental, wait_audio)
+        result = generate_music_and_text(full_prompt, make_instrumental, wait_audio, fresh)
         
         if result:
-            if isinstance(result, list):
-                st.session_state['tracks'] = result
-            elif isinstance(result, dict):
-                st.session_state['tracks'] = [result]
-            else:
+            tracks = suno_api.extract_tracks(result)
+            if not tracks:
                 st.warning("Неожиданный формат ответа от API.")
                 return
+            st.session_state['tracks'] = tracks
+            st.session_state['tracks_pending'] = not wait_audio
+            st.session_state.pop('tracks_page', None)
+            st.session_state.pop('export_path', None)
+            st.session_state.pop('export_selection', None)
+            if not wait_audio:
+                job_poller.get_poller().submit(tracks)
         else:
             st.error("Не удалось получить результаты генерации музыки. Пожалуйста, проверьте введенные данные и попробуйте еще раз.")
 
-    if 'tracks' in st.session_state:
+    if st.session_state.get('tracks_pending'):
+        display_pending_jobs()
+    elif 'tracks' in st.session_state:
         st.subheader("Сгенерированные треки:")
         
-        for i, track in enumerate(st.session_state['tracks']):
-            display_track_info(track, i)
+        display_track_list(st.session_state['tracks'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    metrics.start_exporters()
+    with metrics.rerun_timer("test"):
+        main()
\ No newline at end of file
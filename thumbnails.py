@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+import media_cache
+import metrics
+import singleflight
+
+# Уменьшенные копии обложек для карточек; хранятся рядом с оригиналом в дисковом кэше
+THUMBNAIL_SIZES = tuple(sorted(int(size) for size in os.getenv('THUMBNAIL_SIZES', '160,320,640').split(',')))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+# Повтор скачивания и уменьшения после ошибки: задержка удваивается до THUMBNAIL_RETRY_MAX_DELAY
+THUMBNAIL_RETRY_DELAY = float(os.getenv('THUMBNAIL_RETRY_DELAY', '30'))
+THUMBNAIL_RETRY_MAX_DELAY = float(os.getenv('THUMBNAIL_RETRY_MAX_DELAY', '3600'))
+# Ширина обложки в карточке трека (колонка 1/3 страницы) и на всю ширину страницы
+CARD_WIDTH = int(os.getenv('THUMBNAIL_CARD_WIDTH', '320'))
+PAGE_WIDTH = int(os.getenv('THUMBNAIL_PAGE_WIDTH', '640'))
+
+THUMBNAILS = metrics.counter("thumbnails_total", "Запросы уменьшенных обложек по результату")
+
+
+def pick_size(width):
+    """Наименьший размер из THUMBNAIL_SIZES, не меньше нужной ширины"""
+    return next((size for size in THUMBNAIL_SIZES if size >= width), THUMBNAIL_SIZES[-1])
+
+
+def thumbnail_path(path, size):
+    return media_cache.sidecar_path(path, f".thumb{size}.jpg")
+
+
+def resize_file(path, size, quality=THUMBNAIL_QUALITY):
+    """Уменьшение картинки до size точек по большей стороне (JPEG); выполняется в процессе пула"""
+    from PIL import Image
+
+    target = thumbnail_path(path, size)
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(path) as image:
+            # Для JPEG декодирование сразу в уменьшенном масштабе заметно быстрее
+            image.draft("RGB", (size, size))
+            image.thumbnail((size, size), Image.LANCZOS)
+            image.convert("RGB").save(tmp_path, "JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return target
+
+
+_processes = None
+_threads = None
+_pending = {}
+_in_flight = set()
+# URL -> (число неудачных попыток подряд, когда можно повторить)
+_failed = {}
+_lock = threading.Lock()
+
+
+def _get_processes():
+    global _processes
+    with _lock:
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=max(THUMBNAIL_WORKERS, 1),
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _processes
+
+
+def _finish(key, future):
+    with _lock:
+        _pending.pop(key, None)
+    if future.exception() is None:
+        media_cache.get_cache().add_sidecar(future.result())
+
+
+def thumbnail(path, width=CARD_WIDTH, wait=None):
+    """Путь к уменьшенной копии файла из кэша; если она не успела за wait секунд - исходный путь"""
+    size = pick_size(width)
+    target = thumbnail_path(path, size)
+    if os.path.exists(target):
+        THUMBNAILS.inc(result="hit")
+        return target
+    processes = _get_processes()
+    with _lock:
+        future = _pending.get(target)
+        created = future is None
+        if created:
+            future = _pending[target] = processes.submit(resize_file, path, size)
+    # Вне блокировки: у уже завершенной задачи _finish вызывается сразу и сам берет _lock
+    if created:
+        future.add_done_callback(lambda done: _finish(target, done))
+    try:
+        result = future.result(timeout=wait)
+    except TimeoutError:
+        # Уменьшение продолжается в фоне и пригодится при следующем показе
+        THUMBNAILS.inc(result="pending")
+        return path
+    except Exception:
+        THUMBNAILS.inc(result="error")
+        return path
+    THUMBNAILS.inc(result="made")
+    return result
+
+
+def _fetch_and_resize(url, path, width):
+    try:
+        if path is None:
+            path = singleflight.group("media").do(url, media_cache.get_cache().fetch, url)
+        if thumbnail(path, width) == path:
+            raise ValueError("Не удалось уменьшить обложку")
+        with _lock:
+            _failed.pop(url, None)
+    except Exception:
+        # Пока копии нет, карточка показывает обложку по исходному URL
+        with _lock:
+            failures = _failed.get(url, (0, 0.0))[0] + 1
+            delay = min(THUMBNAIL_RETRY_DELAY * 2 ** (failures - 1), THUMBNAIL_RETRY_MAX_DELAY)
+            _failed[url] = (failures, time.monotonic() + delay)
+    finally:
+        with _lock:
+            _in_flight.discard(url)
+
+
+def local_image(url, width=CARD_WIDTH):
+    """Обложка для st.image: готовая уменьшенная копия нужного размера, а пока ее нет - исходный URL
+
+    Вызывается при отрисовке карточки, поэтому не обращается к сети и ничего не ждет:
+    скачивание в кэш и уменьшение ставятся в фоновую очередь.
+    """
+    if not url:
+        return url
+    path = media_cache.get_cache().lookup(url)
+    if path is not None:
+        target = thumbnail_path(path, pick_size(width))
+        if os.path.exists(target):
+            THUMBNAILS.inc(result="hit")
+            return target
+    global _threads
+    with _lock:
+        failed = _failed.get(url)
+        schedule = url not in _in_flight and not (failed and failed[1] > time.monotonic())
+        if schedule:
+            _in_flight.add(url)
+            if _threads is None:
+                _threads = ThreadPoolExecutor(max_workers=max(THUMBNAIL_WORKERS, 1), thread_name_prefix="thumbnail")
+    if schedule:
+        _threads.submit(_fetch_and_resize, url, path, width)
+    return url
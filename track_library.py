@@ -0,0 +1,229 @@
+import email.utils
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Библиотека всех полученных треков (история генераций)
+TRACK_LIBRARY_DB = os.getenv('TRACK_LIBRARY_DB', os.path.join(tempfile.gettempdir(), 'ai_composer_library.sqlite3'))
+PAGE_SIZE = int(os.getenv('TRACK_LIBRARY_PAGE_SIZE', '20'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    tags TEXT,
+    prompt TEXT,
+    lyric TEXT,
+    model_name TEXT,
+    status TEXT,
+    created_at REAL NOT NULL,
+    audio_url TEXT,
+    image_url TEXT,
+    audio_file TEXT,
+    image_file TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_created_at ON tracks (created_at, id);
+CREATE INDEX IF NOT EXISTS tracks_status_created_at ON tracks (status, created_at, id);
+"""
+
+# Полнотекстовый индекс по тексту песни, промпту, тегам и названию (обновляется триггерами)
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, tags, prompt, lyric, content='tracks', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, title, tags, prompt, lyric)
+    VALUES (new.rowid, new.title, new.tags, new.prompt, new.lyric);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, tags, prompt, lyric)
+    VALUES ('delete', old.rowid, old.title, old.tags, old.prompt, old.lyric);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE ON tracks
+WHEN old.title IS NOT new.title OR old.tags IS NOT new.tags
+  OR old.prompt IS NOT new.prompt OR old.lyric IS NOT new.lyric BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, tags, prompt, lyric)
+    VALUES ('delete', old.rowid, old.title, old.tags, old.prompt, old.lyric);
+    INSERT INTO tracks_fts (rowid, title, tags, prompt, lyric)
+    VALUES (new.rowid, new.title, new.tags, new.prompt, new.lyric);
+END;
+"""
+
+UPSERT = """
+INSERT INTO tracks (id, title, tags, prompt, lyric, model_name, status, created_at,
+                    audio_url, image_url, audio_file, image_file, data, updated_at)
+VALUES (:id, :title, :tags, :prompt, :lyric, :model_name, :status, :created_at,
+        :audio_url, :image_url, :audio_file, :image_file, :data, :updated_at)
+ON CONFLICT (id) DO UPDATE SET
+    title = COALESCE(excluded.title, title),
+    tags = COALESCE(excluded.tags, tags),
+    prompt = COALESCE(excluded.prompt, prompt),
+    lyric = COALESCE(excluded.lyric, lyric),
+    model_name = COALESCE(excluded.model_name, model_name),
+    status = COALESCE(excluded.status, status),
+    audio_url = COALESCE(excluded.audio_url, audio_url),
+    image_url = COALESCE(excluded.image_url, image_url),
+    audio_file = COALESCE(excluded.audio_file, audio_file),
+    image_file = COALESCE(excluded.image_file, image_file),
+    data = excluded.data,
+    updated_at = excluded.updated_at
+"""
+
+COLUMNS = ("title", "tags", "prompt", "lyric", "model_name", "status", "audio_url", "image_url",
+           "audio_file", "image_file")
+
+
+def parse_created_at(value):
+    """Время создания трека из ответа API (ISO 8601 или HTTP-дата) в секундах эпохи"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value:
+        try:
+            return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return time.time()
+
+
+def fts_query(text):
+    """Поисковая строка пользователя в запрос FTS5: все слова, каждое как префикс"""
+    words = [word.replace('"', '""') for word in text.split()]
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class TrackLibrary:
+    """Треки всех генераций в SQLite с постраничной выдачей и полнотекстовым поиском"""
+
+    def __init__(self, path=TRACK_LIBRARY_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            try:
+                conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                # SQLite собран без FTS5: поиск выполняется через LIKE
+                self.fts = False
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, tracks, prompt=None, tags=None):
+        """Сохранение или обновление треков из ответа API; prompt и tags - параметры запроса генерации"""
+        now = time.time()
+        rows = []
+        for track in tracks:
+            if not isinstance(track, dict) or not track.get("id"):
+                continue
+            row = {name: track.get(name) for name in COLUMNS}
+            row["prompt"] = row["prompt"] or prompt
+            row["tags"] = row["tags"] or tags
+            row.update({
+                "id": track["id"],
+                "created_at": parse_created_at(track.get("created_at")),
+                "data": json.dumps(track, ensure_ascii=False),
+                "updated_at": now
+            })
+            rows.append(row)
+        if rows:
+            with self._connect() as conn:
+                conn.executemany(UPSERT, rows)
+
+    def get(self, track_id):
+        """Трек по ID или None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM tracks WHERE id = ?", (track_id,)).fetchone()
+        return self._to_track(row) if row else None
+
+    def page(self, cursor=None, limit=PAGE_SIZE, status=None, query=None):
+        """Страница треков от новых к старым; возвращает (треки, курсор следующей страницы или None)
+
+        Курсор - (created_at, id) последнего трека страницы: выборка идет по индексу
+        и не зависит от номера страницы, в отличие от OFFSET.
+        """
+        sql = "SELECT t.* FROM tracks AS t"
+        where = []
+        params = []
+        if query and query.strip():
+            if self.fts:
+                # Совпадения берутся множеством rowid, а порядок и LIMIT обеспечивает индекс по created_at
+                where.append("t.rowid IN (SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ?)")
+                params.append(fts_query(query))
+            else:
+                like = f"%{query.strip()}%"
+                where.append("(t.title LIKE ? OR t.tags LIKE ? OR t.prompt LIKE ? OR t.lyric LIKE ?)")
+                params.extend([like] * 4)
+        if status:
+            where.append("t.status = ?")
+            params.append(status)
+        if cursor:
+            created_at, track_id = cursor
+            where.append("(t.created_at < ? OR (t.created_at = ? AND t.id < ?))")
+            params.extend([created_at, created_at, track_id])
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY t.created_at DESC, t.id DESC LIMIT ?"
+        # Одна лишняя строка показывает, есть ли следующая страница
+        params.append(limit + 1)
+
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]["created_at"], rows[-1]["id"])
+        return [self._to_track(row) for row in rows], next_cursor
+
+    def iter_tracks(self, status=None, query=None, batch=500):
+        """Все треки по фильтру от новых к старым; читаются страницами, а не целиком"""
+        cursor = None
+        while True:
+            tracks, cursor = self.page(cursor, limit=batch, status=status, query=query)
+            yield from tracks
+            if cursor is None:
+                return
+
+    def statuses(self):
+        """Статусы, встречающиеся в библиотеке"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT status FROM tracks WHERE status IS NOT NULL")]
+
+    def _to_track(self, row):
+        track = json.loads(row["data"])
+        for name in COLUMNS:
+            if row[name] is not None:
+                track[name] = row[name]
+        return track
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_library():
+    """Общий для процесса экземпляр TrackLibrary"""
+    global _library
+    if _library is None:
+        with _library_lock:
+            if _library is None:
+                _library = TrackLibrary()
+    return _library
@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import audio_analysis
+import media_cache
+import metrics
+import singleflight
+
+# Облегченные версии аудио для прослушивания в карточках: весь трек и первые CLIP_SECONDS секунд
+TRANSCODE_ENABLED = os.getenv('AUDIO_PREVIEWS', '1') == '1'
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '2'))
+TRANSCODE_TIMEOUT = float(os.getenv('TRANSCODE_TIMEOUT', '300'))
+PREVIEW_BITRATE = os.getenv('PREVIEW_BITRATE', '64k')
+CLIP_SECONDS = float(os.getenv('PREVIEW_CLIP_SECONDS', '30'))
+# Без ffmpeg WAV уменьшается до моно с частотой не выше PREVIEW_SAMPLE_RATE
+PREVIEW_SAMPLE_RATE = int(os.getenv('PREVIEW_SAMPLE_RATE', '22050'))
+# Повтор подготовки после ошибки: задержка удваивается с каждой неудачей до TRANSCODE_RETRY_MAX_DELAY
+TRANSCODE_RETRY_DELAY = float(os.getenv('TRANSCODE_RETRY_DELAY', '60'))
+TRANSCODE_RETRY_MAX_DELAY = float(os.getenv('TRANSCODE_RETRY_MAX_DELAY', '3600'))
+
+KINDS = ("clip", "preview")
+MIME_TYPES = {".mp3": "audio/mpeg", ".wav": "audio/wav"}
+
+TRANSCODES = metrics.counter("audio_transcodes_total", "Подготовка облегченных версий аудио по виду и результату")
+TRANSCODE_SECONDS = metrics.histogram("audio_transcode_seconds", "Длительность подготовки облегченной версии")
+
+
+def has_ffmpeg():
+    return shutil.which("ffmpeg") is not None
+
+
+def output_path(path, kind, ext):
+    """Файл облегченной версии рядом с файлом в кэше"""
+    return media_cache.sidecar_path(path, f".{kind}{ext}")
+
+
+def _ffmpeg(source, target, seconds=None):
+    command = ["ffmpeg", "-v", "error", "-y", "-i", source, "-vn"]
+    if seconds:
+        command += ["-t", str(seconds)]
+    command += ["-codec:a", "libmp3lame", "-b:a", PREVIEW_BITRATE, "-f", "mp3", target]
+    subprocess.run(command, check=True, timeout=TRANSCODE_TIMEOUT, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def _downsample_wav(source, target, seconds=None):
+    """Моно WAV с пониженной частотой кусками через NumPy (когда ffmpeg нет)"""
+    rate, channels = audio_analysis.audio_format(source)
+    # Деление с округлением вверх: итоговая частота не превышает PREVIEW_SAMPLE_RATE
+    factor = max(-(-rate // PREVIEW_SAMPLE_RATE), 1)
+    limit = int(seconds * rate) if seconds else None
+    written = 0
+    with wave.open(target, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(rate // factor)
+        for samples in audio_analysis.wav_blocks(source, factor * rate):
+            if limit is not None:
+                samples = samples[:limit - written]
+            written += len(samples)
+            usable = len(samples) - len(samples) % factor
+            # Усреднение соседних сэмплов - простейший фильтр перед прореживанием
+            mono = samples[:usable].mean(axis=1).reshape(-1, factor).mean(axis=1)
+            output.writeframes((np.clip(mono, -1, 1) * 32767).astype("<i2").tobytes())
+            if limit is not None and written >= limit:
+                break
+
+
+def transcode_file(path, kind):
+    """Облегченная версия файла (kind - clip или preview); возвращает путь к ней
+
+    Выполняется в процессе пула. С ffmpeg результат - MP3 с битрейтом PREVIEW_BITRATE,
+    без него - моно WAV с пониженной частотой (только для WAV-источников).
+    """
+    seconds = CLIP_SECONDS if kind == "clip" else None
+    if has_ffmpeg():
+        ext, convert = ".mp3", _ffmpeg
+    elif path.lower().endswith(".wav"):
+        ext, convert = ".wav", _downsample_wav
+    else:
+        raise ValueError("Для облегченной версии этого формата нужен ffmpeg")
+    target = output_path(path, kind, ext)
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        convert(path, tmp_path, seconds)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return target
+
+
+def existing(path, kind):
+    """Готовая облегченная версия файла или None"""
+    for ext in MIME_TYPES:
+        candidate = output_path(path, kind, ext)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+_processes = None
+_threads = None
+_in_flight = set()
+# URL -> (число неудачных попыток подряд, когда можно повторить)
+_failed = {}
+_lock = threading.Lock()
+
+
+def _get_processes():
+    global _processes
+    with _lock:
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=max(TRANSCODE_WORKERS, 1),
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _processes
+
+
+def transcode(path):
+    """Подготовка отрывка и облегченной версии файла из кэша (отрывок первым: он готов быстрее)"""
+    results = {}
+    for kind in KINDS:
+        results[kind] = existing(path, kind)
+        if results[kind] is None:
+            with TRANSCODE_SECONDS.time(kind=kind):
+                try:
+                    results[kind] = _get_processes().submit(transcode_file, path, kind).result()
+                except Exception:
+                    TRANSCODES.inc(kind=kind, result="error")
+                    raise
+            media_cache.get_cache().add_sidecar(results[kind])
+            TRANSCODES.inc(kind=kind, result="done")
+    return results
+
+
+def _fetch_and_transcode(url, path):
+    try:
+        if path is None:
+            # Анализ (audio_analysis.py) скачивает тот же файл: одновременные скачивания объединяются
+            path = singleflight.group("media").do(url, media_cache.get_cache().fetch, url)
+        transcode(path)
+        with _lock:
+            _failed.pop(url, None)
+    except Exception:
+        # Без облегченной версии карточка играет исходный файл до следующей попытки
+        with _lock:
+            failures = _failed.get(url, (0, 0.0))[0] + 1
+            delay = min(TRANSCODE_RETRY_DELAY * 2 ** (failures - 1), TRANSCODE_RETRY_MAX_DELAY)
+            _failed[url] = (failures, time.monotonic() + delay)
+    finally:
+        with _lock:
+            _in_flight.discard(url)
+
+
+def _source(path, kind):
+    return path, MIME_TYPES[os.path.splitext(path)[1]], kind
+
+
+def playback_source(url):
+    """Что отдать проигрывателю: (источник, MIME-тип, вид - preview, clip или original)
+
+    Облегченная версия, пока ее нет - отрывок, а пока нет и его - исходный URL. Скачивание
+    в кэш и подготовка недостающих версий идут в фоне, по одной задаче на URL; после ошибки
+    повтор откладывается с растущей задержкой.
+    """
+    if not TRANSCODE_ENABLED or not url:
+        return url, "audio/wav", "original"
+    path = media_cache.get_cache().lookup(url)
+    found = {kind: existing(path, kind) for kind in KINDS} if path else {}
+    if found and all(found.values()):
+        return _source(found["preview"], "preview")
+
+    global _threads
+    with _lock:
+        failed = _failed.get(url)
+        schedule = url not in _in_flight and not (failed and failed[1] > time.monotonic())
+        if schedule:
+            _in_flight.add(url)
+            if _threads is None:
+                _threads = ThreadPoolExecutor(max_workers=max(TRANSCODE_WORKERS, 1), thread_name_prefix="transcode")
+    if schedule:
+        _threads.submit(_fetch_and_transcode, url, path)
+    if found.get("clip"):
+        return _source(found["clip"], "clip")
+    return url, "audio/wav", "original"
@@ -0,0 +1,62 @@
+import asyncio
+import itertools
+import os
+import time
+
+# Сколько вариантов генерируется одновременно и сколько можно отправить за одно нажатие
+VARIANTS_CONCURRENCY = int(os.getenv('VARIANTS_CONCURRENCY', '4'))
+VARIANTS_BUDGET = int(os.getenv('VARIANTS_BUDGET', '8'))
+# Значения темпа, из которых выбираются варианты
+TEMPO_OPTIONS = list(range(60, 201, 10))
+
+
+def expand_grid(build_prompt, base_prompt, genres=(), moods=(), voice_genders=(), additional_params=None,
+                tempos=()):
+    """Все сочетания выбранных жанров, настроений, голосов и темпов в виде [{'label', 'prompt'}]
+
+    build_prompt - построитель промпта формы (generate_prompt), чтобы варианты
+    собирались так же, как одиночный запрос.
+    """
+    variants = []
+    for genre, mood, voice_gender, tempo in itertools.product(list(genres) or [""], list(moods) or [""],
+                                                              list(voice_genders) or [""], list(tempos) or [None]):
+        params = dict(additional_params or {})
+        if tempo is not None:
+            params["Tempo"] = f"{tempo} BPM"
+        label = " / ".join(value for value in (genre, mood, voice_gender, params.get("Tempo") if tempo else "")
+                           if value)
+        variants.append({
+            "label": label or "Базовый вариант",
+            "prompt": build_prompt(base_prompt, genre, mood, voice_gender, params)
+        })
+    return variants
+
+
+async def _generate_all(variants, submit, concurrency):
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def generate_one(variant):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Запросы к API блокирующие, поэтому выполняются в потоках; asyncio ограничивает их число
+                result = await asyncio.to_thread(submit, variant["prompt"])
+                error = None
+            except Exception as e:
+                result = None
+                error = str(e)
+            return dict(variant, result=result, error=error, seconds=time.perf_counter() - start)
+
+    return await asyncio.gather(*(generate_one(variant) for variant in variants))
+
+
+def generate_variants(variants, submit, concurrency=VARIANTS_CONCURRENCY, budget=VARIANTS_BUDGET):
+    """Одновременная генерация вариантов; submit(prompt) отправляет один запрос
+
+    Возвращает варианты в исходном порядке с полями result, error и seconds. Общее время
+    близко ко времени самого долгого запроса, а не к сумме. Если вариантов больше бюджета,
+    ничего не отправляется.
+    """
+    if len(variants) > budget:
+        raise ValueError(f"Выбрано вариантов: {len(variants)}, за один раз можно не больше {budget}")
+    return asyncio.run(_generate_all(variants, submit, concurrency))
@@ -0,0 +1,192 @@
+"""Обработчики очереди заданий генерации (job_queue.py) в отдельных процессах
+
+Запуск:
+    python worker.py --processes 4 --threads 4
+
+Интерфейс Streamlit в режиме JOB_QUEUE_MODE=1 только добавляет задания в очередь и читает
+их состояние, а обработчики выполняют генерацию, опрос статуса и скачивание файлов.
+Обработчики можно запускать и останавливать независимо от интерфейса, в том числе на
+нескольких машинах с общей базой JOB_QUEUE_DB (файловая система должна поддерживать
+блокировки SQLite). Задание, брошенное упавшим обработчиком, после окончания аренды
+подхватывает другой и продолжает с последнего сохраненного этапа.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+import audio_analysis
+import callback_server
+import job_poller
+import job_queue
+import media_cache
+import metrics
+import suno_api
+import thumbnails
+import track_library
+import transcode
+
+IDLE_INTERVAL = float(os.getenv('WORKER_IDLE_INTERVAL', '1'))
+PROGRESS_INTERVAL = float(os.getenv('WORKER_PROGRESS_INTERVAL', '2'))
+# Аренда продлевается в фоне, пока идут долгие этапы (скачивание, анализ, облегченные версии)
+LEASE_RENEW_INTERVAL = float(os.getenv('WORKER_LEASE_RENEW_INTERVAL', str(job_queue.JOB_LEASE_SECONDS / 3)))
+
+JOBS_PROCESSED = metrics.counter("worker_jobs_total", "Задания, обработанные обработчиками очереди")
+
+
+class LeaseLost(Exception):
+    """Аренда задания истекла, и его забрал другой обработчик"""
+
+
+@contextmanager
+def lease_heartbeat(queue, job_id, worker, interval=LEASE_RENEW_INTERVAL):
+    """Продление аренды задания в отдельном потоке; возвращает событие, которое выставляется при потере аренды"""
+    done = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        while not done.wait(interval):
+            try:
+                if not queue.update(job_id, worker):
+                    lost.set()
+                    return
+            except sqlite3.Error:
+                # База занята: аренда продлится при следующей попытке
+                pass
+
+    thread = threading.Thread(target=beat, name=f"lease-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        done.set()
+        thread.join()
+
+
+def process_job(queue, job, worker, lost=None):
+    """Генерация → ожидание готовности → скачивание файлов в дисковый кэш"""
+    job_id = job["id"]
+    tracks = job["tracks"]
+
+    def save(**fields):
+        if (lost is not None and lost.is_set()) or not queue.update(job_id, worker, **fields):
+            raise LeaseLost(job_id)
+
+    if not tracks:
+        params = dict(job["params"], wait_audio=False)
+        tracks = suno_api.extract_tracks(suno_api.submit_generation(user=job["owner"], **params))
+        if not tracks or not all(track.get("id") for track in tracks):
+            raise ValueError("ID задачи не найден в ответе API")
+        save(status=job_queue.POLLING, tracks=tracks)
+
+    poller = job_poller.get_poller()
+    poller.submit(tracks)
+    while True:
+        tracks, pending = job_poller.refresh_tracks(tracks)
+        if not pending:
+            break
+        save(tracks=tracks)
+        # Уведомление о готовности будит обработчик сразу, не дожидаясь интервала
+        poller.wait([track["id"] for track in tracks], PROGRESS_INTERVAL)
+
+    save(status=job_queue.DOWNLOADING, tracks=tracks)
+    cache = media_cache.get_cache()
+    for track in tracks:
+        if track.get("status") != "complete":
+            continue
+        if track.get("audio_url"):
+            track["audio_file"] = cache.fetch(track["audio_url"])
+            try:
+                # Осциллограмма, проверки и облегченные версии для интерфейса готовятся сразу после скачивания
+                audio_analysis.analyze(track["audio_file"])
+                transcode.transcode(track["audio_file"])
+            except Exception:
+                # Анализ и облегченные версии необязательны: трек показывается и без них
+                pass
+            save(tracks=tracks)
+        if track.get("image_url"):
+            track["image_file"] = cache.fetch(track["image_url"])
+            thumbnails.thumbnail(track["image_file"], wait=None)
+
+    track_library.get_library().record(tracks)
+    errors = [track.get("error_message") for track in tracks if track.get("status") == "error"]
+    if errors and len(errors) == len(tracks):
+        save(status=job_queue.FAILED, tracks=tracks, error=errors[0] or "Ошибка генерации")
+    else:
+        save(status=job_queue.DONE, tracks=tracks)
+
+
+def worker_thread(queue, worker, stop):
+    while not stop.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            stop.wait(IDLE_INTERVAL)
+            continue
+        try:
+            with lease_heartbeat(queue, job["id"], worker) as lost:
+                process_job(queue, job, worker, lost)
+            JOBS_PROCESSED.inc(result="done")
+        except LeaseLost:
+            JOBS_PROCESSED.inc(result="lease_lost")
+        except Exception as e:
+            queue.fail(job["id"], worker, str(e))
+            JOBS_PROCESSED.inc(result="error")
+
+
+def run_process(index, threads):
+    """Процесс-обработчик: несколько потоков забирают задания из общей очереди"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    metrics.start_exporters(port=metrics.METRICS_PORT + index if metrics.METRICS_PORT else 0)
+    # У каждого процесса свой приемник уведомлений: задачу опрашивает и ждет тот, кто ее отправил;
+    # порт CALLBACK_PORT остается за интерфейсом
+    callback_server.get_server(port=callback_server.CALLBACK_PORT + 1 + index)
+    queue = job_queue.get_queue()
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    pool = [threading.Thread(target=worker_thread, args=(queue, f"{name}:{i}", stop), daemon=True)
+            for i in range(max(threads, 1))]
+    for thread in pool:
+        thread.start()
+    # При остановке незавершенные задания не дожидаются: после окончания аренды их подхватят другие обработчики
+    try:
+        while not stop.is_set() and any(thread.is_alive() for thread in pool):
+            stop.wait(IDLE_INTERVAL)
+    except KeyboardInterrupt:
+        stop.set()
+
+
+def _interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обработчики очереди заданий генерации")
+    parser.add_argument("--processes", type=int, default=2, help="Число процессов-обработчиков")
+    parser.add_argument("--threads", type=int, default=4, help="Одновременных заданий в одном процессе")
+    args = parser.parse_args(argv)
+
+    job_queue.get_queue()
+    processes = [multiprocessing.Process(target=run_process, args=(i, args.threads), name=f"worker-{i}")
+                 for i in range(max(args.processes, 1))]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, _interrupt)
+    print(f"Запущено обработчиков: {len(processes)} x {args.threads}, очередь: {job_queue.JOB_QUEUE_DB}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
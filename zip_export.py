@@ -0,0 +1,310 @@
+import hashlib
+import hmac
+import json
+import mimetypes
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlparse
+
+import requests
+
+import media_cache
+import metrics
+import singleflight
+
+# Архивы экспорта собираются во временные файлы на диске, а не в памяти
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'ai_composer_exports'))
+# Через сколько секунд старые архивы удаляются
+EXPORT_TTL = float(os.getenv('EXPORT_TTL', '3600'))
+# Сколько файлов одновременно скачивается в кэш, пока архив записывается
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '4'))
+COPY_CHUNK_SIZE = 1024 * 1024
+# Готовые архивы отдаются браузеру отдельным HTTP-сервером потоково, не через память Streamlit.
+# Адрес и порт, на которых он слушает (по умолчанию все интерфейсы, чтобы ссылка работала
+# и у пользователей на других машинах)
+EXPORT_HOST = os.getenv('EXPORT_HOST', '0.0.0.0')
+EXPORT_PORT = int(os.getenv('EXPORT_PORT', '8793'))
+# Внешний адрес сервера архивов (например, за прокси с HTTPS); без него ссылка строится
+# из адреса страницы, открытой в браузере, и порта EXPORT_PORT
+EXPORT_PUBLIC_URL = os.getenv('EXPORT_PUBLIC_URL', '')
+# Секрет подписи ссылок на треки; без него создается общий для процессов файл в EXPORT_DIR
+EXPORT_SECRET = os.getenv('EXPORT_SECRET', '')
+EXPORT_PATH = "/exports/"
+# Отдельные треки: ссылка подписана, поэтому сервер скачивает в кэш только выданные приложением URL
+TRACK_PATH = "/tracks"
+SECRET_FILE = ".secret"
+# Имя архива содержит случайную часть: ссылку на чужой архив не подобрать
+NAME_PATTERN = re.compile(r"^tracks-\d{8}-\d{6}-[0-9a-f]{32}\.zip$")
+
+EXPORTS = metrics.counter("zip_exports_total", "Собранные архивы экспорта")
+EXPORT_TRACKS = metrics.counter("zip_export_tracks_total", "Треки в архивах экспорта")
+EXPORT_BYTES = metrics.counter("zip_export_bytes_total", "Объем архивов экспорта")
+EXPORT_DOWNLOADS = metrics.counter("zip_export_downloads_total", "Скачивания архивов и треков по виду и результату")
+
+# Поля трека, которые не нужны в манифесте (локальные пути процесса)
+PRIVATE_FIELDS = ("audio_file", "image_file")
+
+
+def safe_name(text, limit=60):
+    """Название трека, пригодное для имени файла в архиве"""
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', " ", text or "").strip(" .")
+    return re.sub(r"\s+", " ", name)[:limit].rstrip() or "track"
+
+
+def _extension(url, default):
+    ext = os.path.splitext(url.split("?", 1)[0])[1] if url else ""
+    return ext or default
+
+
+def _local_file(track, file_field, url_field):
+    """Путь к файлу трека: уже скачанный или из дискового кэша; None, если файла нет"""
+    path = track.get(file_field)
+    if path and os.path.exists(path):
+        return path
+    url = track.get(url_field)
+    if not url:
+        return None
+    try:
+        return media_cache.get_cache().fetch(url)
+    except (requests.exceptions.RequestException, OSError):
+        return None
+
+
+def _fetch_files(track):
+    return _local_file(track, "audio_file", "audio_url"), _local_file(track, "image_file", "image_url")
+
+
+def _write_file(archive, name, path, compress_type):
+    """Потоковое копирование файла в архив кусками"""
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.compress_type = compress_type
+    with open(path, "rb") as source, archive.open(info, "w", force_zip64=True) as target:
+        shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+
+def cleanup(directory=EXPORT_DIR, ttl=EXPORT_TTL):
+    """Удаление архивов старше ttl секунд"""
+    now = time.time()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith("."):
+            # Служебные файлы (секрет подписи ссылок)
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def export_zip(tracks, progress=None, directory=EXPORT_DIR):
+    """Сборка ZIP с аудио, обложками, текстами, манифестом manifest.json и плейлистом playlist.m3u
+
+    tracks - любой итерируемый набор треков (в том числе генератор по всей истории).
+    Файлы берутся из дискового кэша и копируются в архив кусками, поэтому память не растет
+    с числом треков. progress(готово) вызывается после каждого трека. Возвращает путь к архиву.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cleanup(directory)
+    path = os.path.join(directory, f"tracks-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex}.zip")
+    tmp_path = path + ".part"
+    manifest = []
+    playlist = ["#EXTM3U"]
+
+    try:
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as archive, \
+                ThreadPoolExecutor(max_workers=max(EXPORT_WORKERS, 1), thread_name_prefix="export") as executor:
+            # Скачивание следующих файлов идет параллельно с записью текущего
+            pending = []
+            tracks = iter(tracks)
+            index = 0
+            while True:
+                while len(pending) < EXPORT_WORKERS * 2:
+                    track = next(tracks, None)
+                    if track is None:
+                        break
+                    pending.append((track, executor.submit(_fetch_files, track)))
+                if not pending:
+                    break
+                track, future = pending.pop(0)
+                audio_path, image_path = future.result()
+
+                base = f"{index + 1:03d} - {safe_name(track.get('title'))} [{str(track.get('id', ''))[:8]}]"
+                files = {}
+                if audio_path:
+                    files["audio"] = f"audio/{base}{_extension(track.get('audio_url'), '.mp3')}"
+                    # Аудио и картинки уже сжаты: сжимать их повторно - только тратить процессор
+                    _write_file(archive, files["audio"], audio_path, zipfile.ZIP_STORED)
+                    playlist.append(f"#EXTINF:{int(track.get('duration') or -1)},{track.get('title') or base}")
+                    playlist.append(files["audio"])
+                if image_path:
+                    files["cover"] = f"covers/{base}{_extension(track.get('image_url'), '.jpeg')}"
+                    _write_file(archive, files["cover"], image_path, zipfile.ZIP_STORED)
+                if track.get("lyric"):
+                    files["lyrics"] = f"lyrics/{base}.txt"
+                    archive.writestr(files["lyrics"], track["lyric"])
+
+                entry = {key: value for key, value in track.items() if key not in PRIVATE_FIELDS}
+                entry["files"] = files
+                manifest.append(entry)
+                index += 1
+                if progress:
+                    progress(index)
+
+            archive.writestr("manifest.json", json.dumps({"exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                                          "tracks": manifest}, ensure_ascii=False, indent=2))
+            archive.writestr("playlist.m3u", "\n".join(playlist) + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    EXPORTS.inc()
+    EXPORT_TRACKS.inc(len(manifest))
+    EXPORT_BYTES.inc(os.path.getsize(path))
+    return path
+
+
+class _ExportHandler(BaseHTTPRequestHandler):
+    """Отдача архивов из EXPORT_DIR и треков из дискового кэша кусками по COPY_CHUNK_SIZE"""
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == TRACK_PATH:
+            self._send_track(parse_qs(parsed.query))
+            return
+        name = unquote(parsed.path[len(EXPORT_PATH):]) if parsed.path.startswith(EXPORT_PATH) else ""
+        if not NAME_PATTERN.match(name):
+            self.send_error(404)
+            return
+        self._send_file(os.path.join(EXPORT_DIR, name), name, "application/zip", "archive")
+
+    def _send_track(self, params):
+        url = params.get("url", [""])[0]
+        signature = params.get("sig", [""])[0]
+        if not url or not hmac.compare_digest(signature, _sign(url)):
+            self.send_error(403)
+            return
+        name = params.get("name", [""])[0]
+        ext = _extension(name, "") or _extension(url, ".bin")
+        name = safe_name(os.path.splitext(name)[0]) + ext
+        try:
+            # Файл скачивается в кэш по запросу браузера и отдается с диска
+            path = singleflight.group("media").do(url, media_cache.get_cache().fetch, url)
+        except (requests.exceptions.RequestException, OSError):
+            EXPORT_DOWNLOADS.inc(kind="track", result="error")
+            self.send_error(502)
+            return
+        self._send_file(path, name, mimetypes.guess_type(name)[0] or "application/octet-stream", "track")
+
+    def _send_file(self, path, name, content_type, kind):
+        try:
+            source = open(path, "rb")
+        except FileNotFoundError:
+            EXPORT_DOWNLOADS.inc(kind=kind, result="missing")
+            self.send_error(404)
+            return
+        with source:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.fstat(source.fileno()).st_size))
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(name)}")
+            self.end_headers()
+            try:
+                shutil.copyfileobj(source, self.wfile, COPY_CHUNK_SIZE)
+            except ConnectionError:
+                EXPORT_DOWNLOADS.inc(kind=kind, result="aborted")
+                return
+        EXPORT_DOWNLOADS.inc(kind=kind, result="done")
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_port = EXPORT_PORT
+_server_lock = threading.Lock()
+
+
+def _ensure_server():
+    """Запуск сервера архивов и треков (один раз на процесс)"""
+    global _server, _server_port
+    with _server_lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((EXPORT_HOST, EXPORT_PORT), _ExportHandler)
+        except OSError:
+            # Порт занят другим процессом приложения: он отдает архивы из того же EXPORT_DIR
+            return
+        _server.daemon_threads = True
+        # Порт 0 - свободный порт, выбранный системой
+        _server_port = _server.server_address[1]
+        threading.Thread(target=_server.serve_forever, name="export-http", daemon=True).start()
+
+
+_secret = None
+
+
+def _get_secret():
+    """Секрет подписи ссылок, общий для процессов с одним EXPORT_DIR"""
+    global _secret
+    if _secret is None:
+        if EXPORT_SECRET:
+            _secret = EXPORT_SECRET.encode("utf-8")
+        else:
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            path = os.path.join(EXPORT_DIR, SECRET_FILE)
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    f.write(secrets.token_hex(32))
+            except FileExistsError:
+                pass
+            with open(path) as f:
+                _secret = f.read().strip().encode("utf-8")
+    return _secret
+
+
+def _sign(url):
+    return hmac.new(_get_secret(), url.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def _base_url(page_url):
+    if EXPORT_PUBLIC_URL:
+        return EXPORT_PUBLIC_URL.rstrip("/")
+    # Браузер обращается к тому же хосту, с которого открыта страница Streamlit
+    host = urlparse(page_url).hostname if page_url else None
+    if not host:
+        host = EXPORT_HOST if EXPORT_HOST not in ("", "0.0.0.0", "::") else "127.0.0.1"
+    if ":" in host:
+        host = f"[{host}]"
+    return f"http://{host}:{_server_port}"
+
+
+def download_url(path, page_url=None):
+    """Ссылка для скачивания собранного архива браузером; page_url - адрес страницы (st.context.url)"""
+    _ensure_server()
+    return _base_url(page_url) + EXPORT_PATH + quote(os.path.basename(path))
+
+
+def track_download_url(url, filename, page_url=None):
+    """Ссылка для скачивания трека браузером: файл берется из кэша (или скачивается в него) и отдается потоково"""
+    _ensure_server()
+    return _base_url(page_url) + TRACK_PATH + "?" + urlencode({"url": url, "name": filename, "sig": _sign(url)})